@@ -0,0 +1,442 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+import discord
+
+# 本番のdbやDiscordには接続しない。main を読み込む前に保存先を一時的なsqliteにする
+os.environ["DS_BOT_STOCK_CONTROL_DB_BACKEND"] = "sqlite"
+os.environ["DS_BOT_STOCK_CONTROL_SQLITE_PATH"] = ":memory:"
+os.environ.setdefault("STOCK_CONTROL_GUILD", "1")
+os.environ.setdefault("STOCK_CONTROL_CHANNEL", "2")
+
+import main  # noqa: E402
+import render_manager  # noqa: E402
+import storage_manager  # noqa: E402
+import utils  # noqa: E402
+from channel_manager import ChannelRegistry, StockChannel  # noqa: E402
+from embed_manager import EmbedManager  # noqa: E402
+from utils import Stock  # noqa: E402
+from view_manager import (  # noqa: E402
+    BoardDecreaseButton,
+    BoardIncreaseButton,
+    StockManageView,
+    debouncer,
+    select_stock,
+)
+
+
+BENCH_SIZES = [10, 100, 1000, 5000]
+BENCH_CLICKS = 2000
+BENCH_CONCURRENCY = 50
+# dbの1回の呼び出しに加える遅延(秒)。firestoreへの往復の目安
+BENCH_DB_LATENCY = 0.02
+# Discord側の時間(APIの応答時間とレート制限の間隔)は TIME_SCALE 倍に縮めて動かす
+BENCH_API_LATENCY = 0.1
+BENCH_RATE_LIMIT = 5  # バケットごとに RATE_PERIOD 秒あたりに受け付ける数
+BENCH_RATE_PERIOD = 5.0
+BENCH_TIME_SCALE = 0.001
+
+
+class LatencyBackend:
+    # ストレージの呼び出しごとに遅延を入れ、呼び出し回数を数える
+    def __init__(self, backend: storage_manager.StorageBackend, latency: float):
+        self._backend = backend
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._backend, name)
+        if not callable(attr) or name in ("watch_stocks", "close"):
+            return attr
+
+        def call(*args, **kwargs):
+            # dbの呼び出しはスレッドプール上で実行されるので、ここでは普通に待つ
+            time.sleep(self.latency)
+            self.calls[name] += 1
+            return attr(*args, **kwargs)
+
+        return call
+
+
+class RateLimiter:
+    # ルート(送信・編集・削除など)ごとのバケット。空になったら次の区切りまで待たせる
+    # discord.py と同じく、429を受け取った側が待ってから送り直す動きを再現する
+    def __init__(self, limit: int, period: float, api_latency: float):
+        self.limit = limit
+        self.period = period
+        self.api_latency = api_latency
+        self.calls: Counter[str] = Counter()
+        self.rate_limited = 0
+        # ルート -> (区切りの時刻, 残り)
+        self._buckets: dict[str, tuple[float, int]] = {}
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    async def request(self, route: str) -> None:
+        self.calls[route] += 1
+        if route == "interaction":
+            # インタラクションへの応答はチャンネルのバケットを使わない
+            await asyncio.sleep(self.api_latency)
+            return
+        async with self._locks.setdefault(route, asyncio.Lock()):
+            while True:
+                now = time.monotonic()
+                reset_at, remaining = self._buckets.get(route, (0.0, 0))
+                if now >= reset_at:
+                    reset_at, remaining = now + self.period, self.limit
+                if remaining > 0:
+                    self._buckets[route] = (reset_at, remaining - 1)
+                    break
+                self.rate_limited += 1
+                await asyncio.sleep(reset_at - now)
+        await asyncio.sleep(self.api_latency)
+
+    @property
+    def channel_calls(self) -> int:
+        # インタラクションへの応答を除いた、チャンネルへのAPIの呼び出し回数
+        return sum(self.calls.values()) - self.calls["interaction"]
+
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", message_id: int, **kwargs):
+        self.channel = channel
+        self.id = message_id
+        self.kwargs = kwargs
+
+    @property
+    def jump_url(self) -> str:
+        return f"https://discord.com/channels/1/{self.channel.id}/{self.id}"
+
+    async def edit(self, **kwargs) -> "FakeMessage":
+        await self.channel.limiter.request("edit")
+        if self.id not in self.channel.messages:
+            raise discord.NotFound(SimpleNamespace(status=404, reason=""), "")
+        self.channel.messages[self.id].kwargs.update(kwargs)
+        return self.channel.messages[self.id]
+
+    async def delete(self) -> None:
+        await self.channel.limiter.request("delete")
+        if self.channel.messages.pop(self.id, None) is None:
+            raise discord.NotFound(SimpleNamespace(status=404, reason=""), "")
+
+
+class FakeChannel:
+    # メッセージをメモリ上に持つテキストチャンネル
+    def __init__(self, limiter: RateLimiter, channel_id: int = 2):
+        self.id = channel_id
+        self.limiter = limiter
+        self.messages: dict[int, FakeMessage] = {}
+        self._next_id = discord.utils.time_snowflake(discord.utils.utcnow())
+
+    def __str__(self) -> str:
+        return f"fake-channel-{self.id}"
+
+    async def send(self, **kwargs) -> FakeMessage:
+        await self.limiter.request("send")
+        self._next_id += 1
+        message = FakeMessage(self, self._next_id, **kwargs)
+        self.messages[message.id] = message
+        return message
+
+    async def delete_messages(self, messages: list[discord.Object]) -> None:
+        await self.limiter.request("bulk_delete")
+        for message in messages:
+            self.messages.pop(message.id, None)
+
+    def get_partial_message(self, message_id: int) -> FakeMessage:
+        return FakeMessage(self, message_id)
+
+    async def history(self, limit: int | None = None):
+        # 100件ずつページングされる分だけリクエストを数える
+        message_ids = sorted(self.messages, reverse=True)[:limit]
+        for start in range(0, max(len(message_ids), 1), 100):
+            await self.limiter.request("history")
+            for message_id in message_ids[start : start + 100]:
+                yield self.messages[message_id]
+
+
+class FakeResponse:
+    # インタラクションへの応答。チャンネルのレート制限は受けず、応答時間だけかかる
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def _respond(self) -> None:
+        if self._done:
+            raise discord.InteractionResponded(self.interaction)
+        await self.interaction.limiter.request("interaction")
+        self._done = True
+        self.interaction.responded_at = time.perf_counter()
+
+    async def edit_message(self, **kwargs) -> None:
+        await self._respond()
+
+    async def defer(self, **kwargs) -> None:
+        await self._respond()
+
+    async def send_message(self, *args, **kwargs) -> None:
+        await self._respond()
+
+    async def send_modal(self, modal: discord.ui.Modal) -> None:
+        await self._respond()
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def send(self, *args, **kwargs) -> None:
+        await self.interaction.limiter.request("interaction")
+
+
+class FakeInteraction:
+    def __init__(self, client: "FakeClient", limiter: RateLimiter):
+        self.client = client
+        self.limiter = limiter
+        self.user = SimpleNamespace(name="benchmark", id=0)
+        self.guild = None
+        self.guild_id = 1
+        self.channel = None
+        self.channel_id = client.channel.id
+        self.message = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.created_at = time.perf_counter()
+        self.responded_at: float | None = None
+
+    async def edit_original_response(self, **kwargs) -> None:
+        await self.limiter.request("interaction")
+
+
+class FakeClient:
+    # Client.start_up とコマンドが使う属性だけを持つ代わりのクライアント
+    start_up = main.Client.start_up
+    load_channel = main.Client.load_channel
+
+    def __init__(self, channels: ChannelRegistry, channel: FakeChannel):
+        self.channels = channels
+        self.embed_manager = EmbedManager()
+        self.channel = channel
+        self.user = SimpleNamespace(name="benchmark", id=0)
+        self.guilds = [SimpleNamespace(id=1)]
+
+    async def sync_commands(self) -> None:
+        pass
+
+    def stock_channel(self, interaction: FakeInteraction) -> StockChannel | None:
+        return self.channels.resolve(interaction.guild_id, interaction.channel_id)
+
+    def get_guild(self, guild_id: int):
+        return SimpleNamespace(id=guild_id, get_channel=lambda _: self.channel)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+def make_catalog(size: int) -> list[Stock]:
+    random.seed(size)
+    groups = [f"group{i}" for i in range(max(size // 20, 1))]
+    stocks = []
+    for i in range(size):
+        group = random.choice(groups)
+        detail = f"item{i}"
+        stocks.append(
+            Stock(
+                detail=detail,
+                group=group,
+                stock_id=utils.generate_id(group + detail),
+                count=random.randint(0, 100),
+                price=random.randint(1, 50) * 10,
+            )
+        )
+    return stocks
+
+
+async def bench_clicks(
+    client: FakeClient,
+    limiter: RateLimiter,
+    stocks: list[Stock],
+    clicks: int,
+    concurrency: int,
+) -> dict:
+    # 同時に concurrency 件ずつボタンを押し、押してから応答するまでの時間を測る
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    renderer = client.channels.channels[client.channel.id].renderer
+
+    async def click(stock: Stock) -> None:
+        async with semaphore:
+            interaction = FakeInteraction(client, limiter)
+            # 押されたボタンのあるメッセージ
+            message_id = renderer.find(stock.stock_id).message_id
+            interaction.message = SimpleNamespace(id=message_id)
+            if render_manager.BOARD_MODE == "group":
+                # グループの表示では、メニューで商品を選んでからボタンを押す
+                select_stock(message_id, interaction.user.id, stock.stock_id)
+                button = random.choice([BoardIncreaseButton(), BoardDecreaseButton()])
+            else:
+                view = StockManageView(stock.stock_id)
+                button = random.choice(view.children[:2])
+            await button.callback(interaction)
+            if interaction.responded_at is not None:
+                latencies.append(interaction.responded_at - interaction.created_at)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(click(random.choice(stocks)) for _ in range(clicks)))
+    elapsed = time.perf_counter() - started
+    return {
+        "clicks_per_second": clicks / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+async def bench_sort(client: FakeClient, limiter: RateLimiter, command) -> dict:
+    # 並べ替え1回で呼んだチャンネルのAPIの数と時間を測る
+    calls = limiter.channel_calls
+    started = time.perf_counter()
+    await command.callback(FakeInteraction(client, limiter))
+    return {
+        "api_calls": limiter.channel_calls - calls,
+        "seconds": time.perf_counter() - started,
+    }
+
+
+async def bench_startup(client: FakeClient, limiter: RateLimiter) -> dict:
+    # ボタンを受け付けられるようになるまで(ready)と、メッセージの確認・更新が終わるまでを測る
+    for stock_channel in client.channels:
+        stock_channel.renderer = None
+    calls = limiter.channel_calls
+    started = time.perf_counter()
+    task = asyncio.create_task(client.start_up())
+    while not task.done() and not all(
+        stock_channel.ready for stock_channel in client.channels
+    ):
+        await asyncio.sleep(0.001)
+    ready = time.perf_counter() - started
+    await task
+    return {
+        "api_calls": limiter.channel_calls - calls,
+        "ready_seconds": ready,
+        "seconds": time.perf_counter() - started,
+    }
+
+
+async def bench_size(size: int, args: argparse.Namespace) -> dict:
+    # 商品数ごとに新しいdbとチャンネルで、起動(初回・再起動)、クリック、並べ替えを測る
+    scale = args.time_scale
+    limiter = RateLimiter(
+        args.rate_limit, args.rate_period * scale, args.api_latency * scale
+    )
+    channel = FakeChannel(limiter)
+    backend = LatencyBackend(storage_manager.SQLiteBackend(":memory:"), 0.0)
+
+    channels = ChannelRegistry(backend, [(1, channel.id, "")])
+    manager = channels.channels[channel.id].db_manager
+    try:
+        stocks = make_catalog(size)
+        await manager.import_stocks(stocks)
+        await manager.events.flush()
+        backend.latency = args.db_latency
+        backend.calls.clear()
+
+        # 空のチャンネルへの初回の起動と、メッセージが残っている状態からの再起動
+        result = {"size": size}
+        result["cold_start"] = await bench_startup(
+            FakeClient(channels, channel), limiter
+        )
+        # 初回の起動の描画を送り終えてから、そのキューを止めて再起動を測る
+        await channels.channels[channel.id].renderer.queue.close()
+        client = FakeClient(channels, channel)
+        result["warm_start"] = await bench_startup(client, limiter)
+        # コマンドは main.client を参照するので、代わりのクライアントに差し替える
+        main.client = client
+
+        result["clicks"] = await bench_clicks(
+            client, limiter, stocks, args.clicks, args.concurrency
+        )
+        # まとめて反映するクリックの編集を、次の商品数に持ち越さないように待つ
+        await asyncio.sleep(debouncer.window)
+        await manager.buffer.flush()
+        for name in ("sort_by_count", "sort_by_price", "sort_by_group"):
+            result[name] = await bench_sort(client, limiter, getattr(main, name))
+        result["rate_limited"] = limiter.rate_limited
+        result["db_calls"] = sum(backend.calls.values())
+        return result
+    finally:
+        await channels.close()
+        # チャンネルのキューなど、次の商品数に持ち越さないタスクを止める
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def report(result: dict) -> str:
+    clicks = result["clicks"]
+    sorts = " / ".join(
+        f"{result[name]['api_calls']}"
+        for name in ("sort_by_count", "sort_by_price", "sort_by_group")
+    )
+    return (
+        f"{result['size']:>6} items | "
+        f"{clicks['clicks_per_second']:>8.0f} clicks/s | "
+        f"p50 {clicks['p50'] * 1000:>7.1f}ms p99 {clicks['p99'] * 1000:>7.1f}ms | "
+        f"sort API calls (count/price/group) {sorts} | "
+        f"startup (ready/done) cold {result['cold_start']['ready_seconds']:.2f}s/"
+        f"{result['cold_start']['seconds']:.2f}s "
+        f"({result['cold_start']['api_calls']} calls) "
+        f"warm {result['warm_start']['ready_seconds']:.2f}s/"
+        f"{result['warm_start']['seconds']:.2f}s "
+        f"({result['warm_start']['api_calls']} calls) | "
+        f"429s {result['rate_limited']} | db calls {result['db_calls']}"
+    )
+
+
+async def run(args: argparse.Namespace) -> None:
+    # main を読み込んだときに作られたdbは使わない
+    await main.client.channels.close()
+
+    for size in args.sizes:
+        print(report(await bench_size(size, args)), flush=True)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Measure click throughput, re-sort cost and startup time "
+        "against fake Discord and storage stand-ins."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCH_SIZES)
+    parser.add_argument("--clicks", type=int, default=BENCH_CLICKS)
+    parser.add_argument("--concurrency", type=int, default=BENCH_CONCURRENCY)
+    parser.add_argument("--db-latency", type=float, default=BENCH_DB_LATENCY)
+    parser.add_argument("--api-latency", type=float, default=BENCH_API_LATENCY)
+    parser.add_argument("--rate-limit", type=int, default=BENCH_RATE_LIMIT)
+    parser.add_argument("--rate-period", type=float, default=BENCH_RATE_PERIOD)
+    parser.add_argument("--time-scale", type=float, default=BENCH_TIME_SCALE)
+    parser.add_argument(
+        "--board-mode", choices=["item", "group"], default=render_manager.BOARD_MODE
+    )
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    render_manager.BOARD_MODE = args.board_mode
+    if not args.verbose:
+        # キューの長さの警告などはベンチマーク中は出し続けるので、エラーだけを表示する
+        logging.getLogger().setLevel(logging.ERROR)
+    asyncio.run(run(args))
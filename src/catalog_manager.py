@@ -0,0 +1,192 @@
+import csv
+import io
+import itertools
+import json
+import tempfile
+from typing import BinaryIO, Iterable, Iterator, TextIO
+
+import aiohttp
+
+import utils
+from storage_manager import MAX_STOCK_COUNT
+from utils import Stock
+
+
+# 書き出すファイルがこのサイズを超えるまではメモリ上に置き、超えたら一時ファイルに移す
+EXPORT_SPOOL_SIZE = 1024 * 1024
+# 読み込むファイルは、この大きさずつ受け取ったり解析したりする
+IMPORT_CHUNK_SIZE = 64 * 1024
+CATALOG_FIELDS = ["stock_id", "group", "detail", "price", "count"]
+
+
+def to_row(stock: Stock) -> dict:
+    return {
+        "stock_id": stock.stock_id,
+        "group": stock.group,
+        "detail": stock.detail,
+        "price": stock.price,
+        "count": stock.count,
+    }
+
+
+def to_catalog_stock(row: dict, position: int) -> Stock:
+    # stock_id は読み込まず、追加時と同じく group と detail から作り直す
+    # count がない行は None にし、既存の商品なら個数をそのまま残す
+    try:
+        group = str(row["group"]).strip()
+        detail = str(row["detail"]).strip()
+        price = int(row["price"])
+        count = row.get("count")
+        count = int(count) if count not in (None, "") else None
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid stock at row {position}: {e}")
+
+    if not group or not detail:
+        raise ValueError(
+            f"Invalid stock at row {position}: group and detail are required."
+        )
+    if count is not None and not 0 <= count <= MAX_STOCK_COUNT:
+        raise ValueError(f"Invalid stock at row {position}: count is out of range.")
+
+    return Stock(
+        detail=detail,
+        group=group,
+        stock_id=utils.generate_id(group + detail),
+        count=count,
+        price=price,
+    )
+
+
+async def download_catalog(url: str) -> tempfile.SpooledTemporaryFile:
+    # 添付ファイルを少しずつ受け取り、全体をメモリに読み込まない(大きければ一時ファイルに移す)
+    file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(IMPORT_CHUNK_SIZE):
+                    file.write(chunk)
+    except aiohttp.ClientError as e:
+        file.close()
+        raise ValueError(f"Could not download the file: {e}")
+    file.seek(0)
+    return file
+
+
+def read_catalog(file: BinaryIO, filename: str) -> Iterator[Stock]:
+    # CSV(ヘッダー付き)または JSON(商品の配列、または1行1商品)を1行ずつ読む
+    # 解析できない場合は、行の位置を付けた ValueError にする
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    try:
+        if filename.lower().endswith(".csv"):
+            yield from read_csv(text)
+            return
+
+        first = text.read(1)
+        while first.isspace():
+            first = text.read(1)
+        if first == "[":
+            for position, row in enumerate(iter_json_array(text), start=1):
+                yield to_catalog_stock(row, position)
+            return
+
+        # JSON Lines
+        lines = itertools.chain([first + text.readline()], text)
+        for position, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON at line {position}: {e.msg}")
+            yield to_catalog_stock(row, position)
+    finally:
+        # 呼び出し側のファイルは閉じない
+        text.detach()
+
+
+def read_csv(text: TextIO) -> Iterator[Stock]:
+    reader = csv.DictReader(text)
+    try:
+        for position, row in enumerate(reader, start=2):
+            yield to_catalog_stock(row, position)
+    except csv.Error as e:
+        # line_num はエラーの行の手前までに読んだ行数
+        raise ValueError(f"Invalid CSV at line {reader.line_num + 1}: {e}")
+
+
+def iter_json_array(text: TextIO) -> Iterator:
+    # "[" の後から配列の要素を1つずつ読み、配列全体の文字列を作らない
+    decoder = json.JSONDecoder()
+    buffer = ""
+    eof = False
+    position = 0
+
+    def fill() -> bool:
+        nonlocal buffer, eof
+        chunk = text.read(IMPORT_CHUNK_SIZE)
+        eof = not chunk
+        buffer += chunk
+        return not eof
+
+    def next_char() -> str:
+        # 空白を読み飛ばした次の文字(ファイルの終わりなら "")
+        nonlocal buffer
+        while True:
+            buffer = buffer.lstrip()
+            if buffer or not fill():
+                return buffer[:1]
+
+    if next_char() == "]":
+        return
+    while True:
+        position += 1
+        next_char()
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError as e:
+                # 要素の途中で区切れているだけなら、続きを読んでからやり直す
+                if fill():
+                    continue
+                raise ValueError(f"Invalid JSON at item {position}: {e.msg}")
+            # 数値などは続きがあるかもしれないので、後ろに文字がある状態で解析する
+            if end == len(buffer) and fill():
+                continue
+            break
+        buffer = buffer[end:]
+        yield value
+
+        separator = next_char()
+        buffer = buffer[1:]
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError(f"Invalid JSON after item {position}: expected ',' or ']'")
+
+
+def write_catalog(
+    stocks: Iterable[Stock], format: str
+) -> tempfile.SpooledTemporaryFile:
+    # 1商品ずつファイルに書き出し、大きな文字列を組み立てない
+    file = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    text = io.TextIOWrapper(file, encoding="utf-8", newline="", write_through=True)
+
+    if format == "csv":
+        writer = csv.DictWriter(text, fieldnames=CATALOG_FIELDS)
+        writer.writeheader()
+        for stock in stocks:
+            writer.writerow(to_row(stock))
+    else:
+        text.write("[\n")
+        for i, stock in enumerate(stocks):
+            text.write(
+                ("" if i == 0 else ",\n")
+                + json.dumps(to_row(stock), ensure_ascii=False)
+            )
+        text.write("\n]\n")
+
+    # TextIOWrapper を閉じると下のファイルも閉じるので切り離す
+    text.detach()
+    file.seek(0)
+    return file
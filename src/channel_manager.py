@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+
+from db_manager import DBManager
+from render_manager import GroupBoardRenderer, RenderManager
+from storage_manager import StorageBackend
+from utils import ERROR
+
+
+# 商品一覧を置くチャンネル。"guild_id:channel_id" をカンマ区切りで並べる
+# 未設定なら STOCK_CONTROL_GUILD と STOCK_CONTROL_CHANNEL の1チャンネルで、従来のコレクションを使う
+STOCK_CONTROL_TARGETS = os.getenv("STOCK_CONTROL_TARGETS", "")
+
+
+@dataclass
+class StockChannel:
+    guild_id: int
+    channel_id: int
+    db_manager: DBManager
+    # チャンネルを読み込むまでは None
+    renderer: RenderManager | GroupBoardRenderer | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self.renderer is not None
+
+
+def parse_targets(text: str = STOCK_CONTROL_TARGETS) -> list[tuple[int, int]]:
+    targets = []
+    for target in text.split(","):
+        if not target.strip():
+            continue
+        guild_id, separator, channel_id = target.strip().partition(":")
+        if not separator:
+            raise ValueError(f"Invalid stock control target: {target}")
+        targets.append((int(guild_id), int(channel_id)))
+    return targets
+
+
+def namespace_for(guild_id: int, channel_id: int) -> str:
+    return f"{guild_id}_{channel_id}"
+
+
+def load_targets() -> list[tuple[int, int, str]]:
+    # (guild_id, channel_id, namespace) の一覧
+    targets = parse_targets()
+    if targets:
+        return [
+            (guild_id, channel_id, namespace_for(guild_id, channel_id))
+            for guild_id, channel_id in targets
+        ]
+    return [
+        (
+            int(os.getenv("STOCK_CONTROL_GUILD")),
+            int(os.getenv("STOCK_CONTROL_CHANNEL")),
+            "",
+        )
+    ]
+
+
+class ChannelRegistry:
+    # チャンネルごとに商品一覧(DBManager)と描画(RenderManager)を持つ
+    # 描画のキューもdbのスレッドプールもチャンネルごとなので、あるチャンネルの並べ替えが
+    # 他のチャンネルのボタンの処理を待たせない
+    def __init__(
+        self,
+        backend: StorageBackend,
+        targets: list[tuple[int, int, str]] | None = None,
+    ):
+        self.backend = backend
+        self.channels = {
+            channel_id: StockChannel(
+                guild_id, channel_id, DBManager(backend, namespace)
+            )
+            for guild_id, channel_id, namespace in (targets or load_targets())
+        }
+
+    def __iter__(self):
+        return iter(self.channels.values())
+
+    def __len__(self) -> int:
+        return len(self.channels)
+
+    def resolve(
+        self, guild_id: int | None, channel_id: int | None
+    ) -> StockChannel | None:
+        # 商品一覧のチャンネルならそのチャンネル、そうでなければサーバーに1つだけある商品一覧
+        stock_channel = self.channels.get(channel_id)
+        if stock_channel is not None:
+            return stock_channel
+        candidates = [
+            stock_channel
+            for stock_channel in self.channels.values()
+            if stock_channel.guild_id == guild_id
+        ]
+        return candidates[0] if len(candidates) == 1 else None
+
+    @property
+    def db_manager(self) -> DBManager:
+        # チャンネルに属さない状態(コマンドの同期など)の読み書きに使う
+        # 保存先の接続は全チャンネルで共有しているので、どのチャンネルのものでもよい
+        return next(iter(self)).db_manager
+
+    async def connect(self) -> None:
+        await self.db_manager.connect()
+
+    async def close(self) -> None:
+        results = await asyncio.gather(
+            *(stock_channel.db_manager.close() for stock_channel in self),
+            return_exceptions=True,
+        )
+        for stock_channel, result in zip(self, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    ERROR
+                    + f"Error occurred while closing channel {stock_channel.channel_id}:\n{result}"
+                )
+
+        # 書き込み後の表示の更新も含めて、キューに残っている編集を送り終えてから終わる
+        renderers = [
+            stock_channel.renderer for stock_channel in self if stock_channel.ready
+        ]
+        results = await asyncio.gather(
+            *(renderer.queue.close() for renderer in renderers),
+            return_exceptions=True,
+        )
+        for renderer, result in zip(renderers, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    ERROR
+                    + f"Error occurred while draining channel queue {renderer.channel}:\n{result}"
+                )
+        self.backend.close()
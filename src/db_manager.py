@@ -1,113 +1,753 @@
+import asyncio
+import functools
+import heapq
+import logging
 import os
-import requests
-
-import firebase_admin
-from firebase_admin import credentials, firestore
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from typing import Iterable
 
+import event_manager
+import rollup_manager
+import search_manager
+import storage_manager
 import utils
-from utils import Stock
+from metrics_manager import metrics
+from storage_manager import MAX_STOCK_COUNT
+from utils import ERROR, WARN, Stock
 
 
-class DBManager(metaclass=utils.Singleton):
-    def __init__(self):
-        # firebaseを使わない場合は環境変数に直接、値を入れる
-        url = os.getenv("DS_BOT_STOCK_CONTROL_DB_CRED")
-        self.cred = credentials.Certificate(requests.get(url).json())
-        firebase_admin.initialize_app(self.cred)
-        self.db = firestore.client()
+# 書き込みをまとめるまでの秒数と、溜まったクリック数の上限
+FLUSH_INTERVAL = float(os.getenv("DS_BOT_STOCK_CONTROL_FLUSH_INTERVAL", "1.0"))
+FLUSH_BATCH_SIZE = int(os.getenv("DS_BOT_STOCK_CONTROL_FLUSH_BATCH_SIZE", "50"))
+# 書き込みがこの回数続けて失敗したら差分を諦め、表示をdb上の値に戻す
+FLUSH_MAX_FAILURES = int(os.getenv("DS_BOT_STOCK_CONTROL_FLUSH_MAX_FAILURES", "5"))
+# ストレージの同期APIを実行するスレッド数、同時に投げる呼び出しの上限、1回の呼び出しのタイムアウト秒数(差分の加算を除く)
+DB_MAX_WORKERS = int(os.getenv("DS_BOT_STOCK_CONTROL_DB_MAX_WORKERS", "16"))
+DB_MAX_CONCURRENCY = int(os.getenv("DS_BOT_STOCK_CONTROL_DB_MAX_CONCURRENCY", "64"))
+DB_TIMEOUT = float(os.getenv("DS_BOT_STOCK_CONTROL_DB_TIMEOUT", "10.0"))
+# 商品一覧のキャッシュ。リスナーが使えない間はTTL秒ごとに読み直す
+CACHE_TTL = float(os.getenv("DS_BOT_STOCK_CONTROL_CACHE_TTL", "300"))
+CACHE_LISTEN = os.getenv("DS_BOT_STOCK_CONTROL_CACHE_LISTEN", "1") == "1"
+# まとめて増減できる商品数(firestoreの1回のバッチの上限)
+BULK_ADJUST_LIMIT = storage_manager.FIRESTORE_BATCH_LIMIT
+# 商品の一括追加で1回に書き込む商品数
+IMPORT_BATCH_SIZE = storage_manager.FIRESTORE_BATCH_LIMIT
 
-    def set(self, collection: str, document: str | None, data: dict) -> None:
-        self.db.collection(collection).document(document).set(data)
 
-    def get(self, collection: str, document: str | None) -> dict:
-        if document:
-            return self.db.collection(collection).document(document).get().to_dict()
+class StockCache:
+    # stock_id -> Stock をプロセス全体で保持する
+    # リスナーのコールバックは別スレッドから呼ばれるのでロックで守る
+    def __init__(self, ttl: float = CACHE_TTL):
+        self.ttl = ttl
+        self.watch = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._stocks: dict[str, Stock] = {}
+        self._loaded_at: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_at is not None
+
+    @property
+    def listening(self) -> bool:
+        return self.watch is not None and self.watch.is_active
+
+    def is_fresh(self) -> bool:
+        if not self.loaded:
+            return False
+        if self.listening:
+            return True
+        return time.monotonic() - self._loaded_at < self.ttl
+
+    def replace_all(self, stocks: dict[str, Stock]) -> None:
+        with self._lock:
+            self._stocks = stocks
+            self._loaded_at = time.monotonic()
+
+    def reset(self) -> None:
+        self.close()
+        with self._lock:
+            self._stocks = {}
+            self._loaded_at = None
+
+    def put(self, stock: Stock) -> None:
+        with self._lock:
+            self._stocks[stock.stock_id] = replace(stock)
+
+    def remove(self, stock_id: str) -> None:
+        with self._lock:
+            self._stocks.pop(stock_id, None)
+
+    def update_count(self, stock_id: str, count: int) -> None:
+        with self._lock:
+            if stock_id in self._stocks:
+                self._stocks[stock_id].count = count
+
+    def contains(self, stock_id: str) -> bool:
+        return self.is_fresh() and stock_id in self._stocks
+
+    def peek(self, stock_id: str) -> Stock | None:
+        # 統計に数えずに、鮮度も問わずに参照する
+        with self._lock:
+            stock = self._stocks.get(stock_id)
+        return replace(stock) if stock is not None else None
+
+    def lookup(self, stock_id: str) -> Stock | None:
+        with self._lock:
+            stock = self._stocks.get(stock_id)
+        if stock is None or not self.is_fresh():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return replace(stock)
+
+    def page(self, after: tuple[str, str] | None, limit: int) -> list[Stock]:
+        # (group, stock_id) の順で after より後の商品を limit 件だけ、全件を複製せずに取り出す
+        with self._lock:
+            stocks = heapq.nsmallest(
+                limit,
+                (
+                    stock
+                    for stock in self._stocks.values()
+                    if after is None or (stock.group, stock.stock_id) > after
+                ),
+                key=lambda stock: (stock.group, stock.stock_id),
+            )
+            return [replace(stock) for stock in stocks]
+
+    def values(self) -> list[Stock]:
+        with self._lock:
+            return [replace(stock) for stock in self._stocks.values()]
+
+    def stats(self) -> dict:
         return {
-            doc.id: doc.to_dict() for doc in self.db.collection(collection).stream()
+            "size": len(self._stocks),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "listening": self.listening,
+            "age": (time.monotonic() - self._loaded_at if self._loaded_at else None),
         }
 
-    def delete(self, collection: str, document: str | None) -> None:
-        self.db.collection(collection).document(document).delete()
+    def close(self) -> None:
+        if self.watch is not None:
+            self.watch.unsubscribe()
+            self.watch = None
 
-    async def increment_stock(self, stock: Stock) -> Stock:
-        stock_data = self.get(collection="stocks", document=stock.stock_id)
 
-        if stock_data["count"] + stock.count > 9000000000000000:
-            raise ValueError("The stock count is too high.")
-        else:
-            stock_data["count"] += stock.count
+class CounterBuffer:
+    # ボタンの押下をメモリ上で合算し、一定間隔または一定回数ごとにまとめて書き込む
+    def __init__(
+        self,
+        db_manager: "DBManager",
+        flush_interval: float = FLUSH_INTERVAL,
+        batch_size: int = FLUSH_BATCH_SIZE,
+    ):
+        self.db_manager = db_manager
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._stocks: dict[str, Stock] = {}  # db上で確定している値
+        self._pending: dict[str, int] = {}  # まだ書き込んでいない差分
+        self._inflight: dict[str, int] = {}  # 書き込み中の差分
+        self._pending_clicks = 0
+        self._failures = 0
+        self._lock = asyncio.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        # 書き込み後の値を受け取るコールバック(表示中の内容とのずれを直すのに使う)
+        self.on_flushed = None
+        self._callbacks: set[asyncio.Task] = set()
+
+    def _ensure_task(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # 停止時に書き込みが途中で中断されないようにする
+            await asyncio.shield(self.flush())
+
+    def _projected_count(self, stock_id: str) -> int:
+        return (
+            self._stocks[stock_id].count
+            + self._inflight.get(stock_id, 0)
+            + self._pending.get(stock_id, 0)
+        )
 
-        self.set(collection="stocks", document=stock.stock_id, data=stock_data)
+    def projected(self, stock_id: str) -> Stock | None:
+        stock = self._stocks.get(stock_id)
+        if stock is None:
+            return None
         return Stock(
-            detail=stock_data["detail"],
-            stock_id=stock.stock_id,
-            count=stock_data["count"],
-            price=stock_data["price"],
-            group=stock_data["group"],
+            detail=stock.detail,
+            stock_id=stock_id,
+            count=self._projected_count(stock_id),
+            price=stock.price,
+            group=stock.group,
         )
 
-    async def decrease_stock(self, stock: Stock) -> Stock:
-        stock_data = self.get(collection="stocks", document=stock.stock_id)
+    def knows(self, stock_id: str) -> bool:
+        return stock_id in self._stocks
 
-        if stock_data["count"] - stock.count < 0:
-            stock_data["count"] = 0
-        else:
-            stock_data["count"] -= stock.count
+    async def add(self, stock_id: str, delta: int, clamp: bool = True) -> Stock:
+        # 初回のみdbから現在値を読み込み、以降はメモリ上の値に差分を足していく
+        if stock_id not in self._stocks:
+            self._stocks[stock_id] = await self.db_manager.get_stock(stock_id)
+
+        async with self._lock:
+            current = self._projected_count(stock_id)
+            if current + delta > MAX_STOCK_COUNT:
+                raise ValueError("The stock count is too high.")
+            if not clamp and current + delta < 0:
+                raise ValueError("The stock count cannot be negative.")
+            # 0未満にはならないように差分を切り詰める
+            delta = max(delta, -current)
+            self._pending[stock_id] = self._pending.get(stock_id, 0) + delta
+            self._pending_clicks += 1
+
+            if self._pending_clicks >= self.batch_size:
+                self._wakeup.set()
+
+        self._ensure_task()
+        return self.projected(stock_id)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            async with self._lock:
+                self._inflight = {k: v for k, v in self._pending.items() if v != 0}
+                self._pending = {}
+                self._pending_clicks = 0
+
+            if not self._inflight:
+                return
+
+            try:
+                counts = await self.db_manager.apply_deltas(self._inflight)
+            except Exception as e:
+                self._failures += 1
+                logging.error(
+                    ERROR + f"Error occurred while flushing stock counts:\n{e}"
+                )
+                if isinstance(e, storage_manager.PartialWriteError):
+                    # 書き込めた商品は確定し、書き込めなかった商品の差分だけを残す
+                    for stock_id in self._inflight:
+                        if stock_id not in e.counts and stock_id not in e.failed:
+                            self.forget(stock_id)
+                    self._confirm(e.counts)
+                    self._inflight = {
+                        stock_id: delta
+                        for stock_id, delta in self._inflight.items()
+                        if stock_id in e.failed
+                    }
+                    self._notify(list(e.counts))
+                if self._failures >= FLUSH_MAX_FAILURES:
+                    # 書き込めなかった差分は捨て、楽観的に更新した表示を元に戻す
+                    logging.error(
+                        ERROR + f"Dropped unsaved stock counts: {self._inflight}"
+                    )
+                    failed = list(self._inflight)
+                    self._inflight = {}
+                    self._failures = 0
+                    self._notify(failed)
+                    return
+
+                # 書き込みに失敗した差分は次回の書き込みに持ち越す
+                async with self._lock:
+                    for stock_id, delta in self._inflight.items():
+                        self._pending[stock_id] = self._pending.get(stock_id, 0) + delta
+                    self._inflight = {}
+                return
+
+            self._failures = 0
+            for stock_id in self._inflight:
+                if stock_id not in counts:
+                    self.forget(stock_id)
+            self._confirm(counts)
+            self._inflight = {}
+            self._notify(list(counts))
+
+    def _confirm(self, counts: dict[str, int]) -> None:
+        # 書き込み結果の値で確定値を更新する(他からの更新もここで反映される)
+        for stock_id, count in counts.items():
+            if stock_id in self._stocks:
+                self._stocks[stock_id].count = count
+
+    def _notify(self, stock_ids: list[str]) -> None:
+        if self.on_flushed is None:
+            return
+        stocks = [self.projected(stock_id) for stock_id in stock_ids]
+        task = asyncio.create_task(
+            self.on_flushed([stock for stock in stocks if stock is not None])
+        )
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def update_stock(self, stock: Stock) -> None:
+        # 商品の内容が書き換えられたときに確定値を差し替える(溜まっている差分は残す)
+        if stock.stock_id in self._stocks:
+            self._stocks[stock.stock_id] = replace(stock)
+
+    def confirm(self, stock_id: str, count: int) -> None:
+        # バッファを通さずに書き込んだ個数を確定値に反映する
+        if stock_id in self._stocks:
+            self._stocks[stock_id].count = count
+
+    def forget(self, stock_id: str) -> None:
+        self._stocks.pop(stock_id, None)
+        self._pending.pop(stock_id, None)
+
+
+class DBManager:
+    # 商品一覧を置くチャンネルごとに1つ作る。ストレージの接続はチャンネル間で共有する
+    def __init__(
+        self,
+        backend: storage_manager.StorageBackend | None = None,
+        namespace: str = "",
+    ):
+        # 保存先は環境変数 DS_BOT_STOCK_CONTROL_DB_BACKEND で選ぶ(渡された場合はそれを使う)
+        self._owns_backend = backend is None
+        self.backend = backend or storage_manager.create_backend()
+        # コレクションは catalogs/<namespace>/ の下に分ける("" なら従来のコレクション)
+        self.namespace = namespace
+        self.stocks_collection = self.collection("stocks")
+        self.buffer = CounterBuffer(self)
+
+        # 同期APIはイベントループを止めないようにスレッドプール上で実行する
+        self.timeout = DB_TIMEOUT
+        self._executor = ThreadPoolExecutor(
+            max_workers=DB_MAX_WORKERS, thread_name_prefix="db"
+        )
+        self._semaphore = asyncio.Semaphore(DB_MAX_CONCURRENCY)
+
+        self.cache = StockCache()
+        # 商品名の検索用のインデックス。キャッシュと同じ契機で更新する
+        self.search = search_manager.StockIndex()
+        # 個数の変更履歴。環境変数 DS_BOT_STOCK_CONTROL_EVENT_LOG で保存先を選ぶ
+        self.events = event_manager.EventLog(
+            self,
+            event_manager.create_event_store(
+                self.backend,
+                collection=self.collection("events"),
+                path=event_manager.namespaced_path(namespace),
+            ),
+        )
+        # 時間帯・日・グループごとの売上の集計
+        self.rollups = rollup_manager.SalesRollups(self)
+        # 現在の売上の合計(全体・グループごと)
+        self.totals = rollup_manager.SalesTotals(self)
+
+    def collection(self, name: str) -> str:
+        if not self.namespace:
+            return name
+        return f"catalogs/{self.namespace}/{name}"
+
+    async def _run(self, func, *args, **kwargs):
+        return await self._call(self.timeout, func, *args, **kwargs)
+
+    async def _run_write(self, func, *args, **kwargs):
+        # 差分の加算は、待つのをやめてもスレッド上では書き込まれてしまい、
+        # 失敗として送り直すと二重に反映されるので、時間の上限を設けずに結果を待つ
+        return await self._call(None, func, *args, **kwargs)
+
+    async def _call(self, timeout: float | None, func, *args, **kwargs):
+        # 呼び出したメソッドごとに、スレッドプールの待ちも含めた時間を記録する
+        name = getattr(func, "__name__", type(func).__name__)
+        started = time.perf_counter()
+        try:
+            async with self._semaphore:
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(
+                    self._executor, functools.partial(func, *args, **kwargs)
+                )
+                try:
+                    return await asyncio.wait_for(future, timeout=timeout)
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"{name} timed out after {timeout}s.") from None
+        except Exception:
+            metrics.increment("db_errors_total", name)
+            raise
+        finally:
+            metrics.observe("db_call_seconds", name, time.perf_counter() - started)
+
+    async def connect(self) -> None:
+        # 保存先への接続を先に済ませておき、最初の読み込みやボタンの処理で待たないようにする
+        await self._run(self.backend.connect)
+
+    def set(self, collection: str, document: str | None, data: dict) -> None:
+        self.backend.set(collection, document, data)
+
+    def get(self, collection: str, document: str | None) -> dict:
+        return self.backend.get(collection, document)
 
-        self.set(collection="stocks", document=stock.stock_id, data=stock_data)
+    def delete(self, collection: str, document: str | None) -> None:
+        self.backend.delete(collection, document)
+
+    def _on_stock_change(
+        self, stocks: list[Stock], removed: list[str], initial: bool
+    ) -> None:
+        if initial:
+            self.cache.replace_all({stock.stock_id: stock for stock in stocks})
+            self.search.rebuild(stocks)
+            return
+        for stock in stocks:
+            self.cache.put(stock)
+            self.search.put(stock)
+        for stock_id in removed:
+            self.cache.remove(stock_id)
+            self.search.remove(stock_id)
+
+    def _load_stocks(self) -> None:
+        # リスナーを張れるストレージなら、最初に受け取った一覧を読み込む
+        if CACHE_LISTEN and not self.cache.listening:
+            self.cache.reset()
+            loaded = threading.Event()
+
+            def on_change(stocks, removed, initial):
+                self._on_stock_change(stocks, removed, initial)
+                loaded.set()
+
+            watch = self.backend.watch_stocks(self.stocks_collection, on_change)
+            if watch is not None:
+                self.cache.watch = watch
+                if loaded.wait(timeout=self.timeout / 2):
+                    return
+                # リスナーが使えない場合はTTL付きの通常の読み込みにフォールバックする
+                logging.warning(
+                    WARN + "Snapshot listener did not respond, polling instead."
+                )
+                self.cache.close()
+
+        stocks = self.backend.get_stocks(self.stocks_collection)
+        self.cache.replace_all({stock.stock_id: stock for stock in stocks})
+        self.search.rebuild(stocks)
+
+    async def _ensure_cache(self) -> None:
+        if self.cache.is_fresh():
+            return
+        if self.cache.loaded:
+            self.cache.stale += 1
+        await self._run(self._load_stocks)
+
+    async def refresh_cache(self) -> None:
+        self.cache.close()
+        await self._run(self._load_stocks)
+
+    async def apply_deltas(self, deltas: dict[str, int]) -> dict[str, int]:
+        try:
+            counts = await self._run_write(
+                self.backend.apply_deltas, self.stocks_collection, deltas
+            )
+        except storage_manager.PartialWriteError as e:
+            self._applied(e.counts, deltas)
+            raise
+        self._applied(counts, deltas)
+        return counts
+
+    def _applied(self, counts: dict[str, int], deltas: dict[str, int]) -> None:
+        for stock_id, count in counts.items():
+            delta = self._actual_delta(stock_id, deltas[stock_id], count)
+            self.cache.update_count(stock_id, count)
+            self._record_change(stock_id, delta, count)
+
+    def _actual_delta(self, stock_id: str, delta: int, count: int) -> int:
+        # 0未満にならないよう切り詰められた場合は、実際に減った分を返す
+        # (書き込む前の個数はキャッシュの値を使うので、キャッシュを更新する前に呼ぶ)
+        if count > 0 or delta >= 0:
+            return delta
+        previous = self.cache.peek(stock_id)
+        if previous is None:
+            return delta
+        return max(delta, -previous.count)
+
+    def _record_change(
+        self, stock_id: str, delta: int, count: int, stock: Stock | None = None
+    ) -> None:
+        self.events.record(stock_id, "delta", delta, count)
+        stock = stock or self.buffer.projected(stock_id) or self.cache.peek(stock_id)
+        if stock is not None:
+            self.rollups.record(stock, delta)
+            self.totals.record(stock.group, delta * (stock.price or 0))
+
+    async def reconcile(self) -> dict[str, tuple[int | None, int]]:
+        # 保存されている個数と、イベントから組み立て直した個数が異なる商品を返す
+        # stock_id -> (保存されている個数, 組み立て直した個数)
+        # 履歴を記録し始めてから変わっていない商品は組み立て直せないので比べない
+        await self.buffer.flush()
+        rebuilt = await self.events.rebuild()
+        stocks = await self._run(self.backend.get_stocks, self.stocks_collection)
+        stored = {stock.stock_id: stock.count for stock in stocks}
+
+        drift = {
+            stock_id: (stored.get(stock_id), count)
+            for stock_id, count in rebuilt.items()
+            if stored.get(stock_id) != count
+        }
+        if drift:
+            logging.warning(WARN + f"Stock counts differ from the event log: {drift}")
+        return drift
+
+    async def get_layout(self, key: str) -> list[dict] | None:
+        # key はチャンネルID(表示方法ごとに分ける場合は接尾辞付き)
+        data = await self._run(
+            self.get, collection=self.collection("layouts"), document=key
+        )
+        return data["slots"] if data else None
+
+    async def save_layout(self, key: str, slots: list[dict]) -> None:
+        await self._run(
+            self.set,
+            collection=self.collection("layouts"),
+            document=key,
+            data={"slots": slots},
+        )
+
+    async def get_board_selection(self, message_id: int, user_id: int) -> str | None:
+        # グループごとの表示で、ユーザーがメッセージのメニューから選んだ商品
+        data = await self._run(
+            self.get,
+            collection=self.collection("board_selections"),
+            document=f"{message_id}_{user_id}",
+        )
+        return data["stock_id"] if data else None
+
+    async def save_board_selection(
+        self, message_id: int, user_id: int, stock_id: str
+    ) -> None:
+        await self._run(
+            self.set,
+            collection=self.collection("board_selections"),
+            document=f"{message_id}_{user_id}",
+            data={"stock_id": stock_id},
+        )
+
+    async def get_commands_hash(self, application_id: int) -> str | None:
+        # コマンドはチャンネルごとではなくボットごとなので、名前空間には分けない
+        data = await self._run(
+            self.get, collection="commands", document=str(application_id)
+        )
+        return data["hash"] if data else None
+
+    async def save_commands_hash(self, application_id: int, digest: str) -> None:
+        await self._run(
+            self.set,
+            collection="commands",
+            document=str(application_id),
+            data={"hash": digest},
+        )
+
+    def can_answer_locally(self, stock_id: str) -> bool:
+        # ネットワークを使わずに新しい個数を出せるかどうか
+        return self.buffer.knows(stock_id) or self.cache.contains(stock_id)
+
+    async def queue_adjust(
+        self, stock_id: str, delta: int, clamp: bool = True
+    ) -> Stock:
+        # clamp が False なら、0未満になる差分は切り詰めずに ValueError にする
+        return await self.buffer.add(stock_id, delta, clamp)
+
+    async def apply_adjustments(self, deltas: dict[str, int]) -> list[Stock]:
+        # 複数の商品の差分を検証し、1回の書き込みでまとめて反映する
+        if len(deltas) > BULK_ADJUST_LIMIT:
+            raise ValueError(f"Too many stocks in one batch (max {BULK_ADJUST_LIMIT}).")
+        # 溜まっているクリックを先に書き込み、検証に使う個数に含める
+        await self.buffer.flush()
+        counts = await self._run_write(
+            self.backend.apply_checked_deltas, self.stocks_collection, deltas
+        )
+
+        stocks = []
+        for stock_id, count in counts.items():
+            self.buffer.confirm(stock_id, count)
+            self.cache.update_count(stock_id, count)
+            stock = self.buffer.projected(stock_id) or self.cache.peek(stock_id)
+            if stock is None:
+                stock = await self.get_stock(stock_id)
+            self._record_change(stock_id, deltas[stock_id], count, stock)
+            stocks.append(stock)
+        return stocks
+
+    async def import_stocks(self, stocks: Iterable[Stock]) -> int:
+        # IMPORT_BATCH_SIZE 件ずつまとめて書き込み、書き込んだ商品数を返す
+        # count が None の商品は、既存の商品なら今の個数を、新しい商品なら0を使う
+        await self.buffer.flush()
+        existing = {stock.stock_id: stock for stock in await self.get_all_stock()}
+
+        imported = 0
+        batch: list[Stock] = []
+        for stock in stocks:
+            batch.append(stock)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                imported += await self._import_batch(batch, existing)
+                batch = []
+        if batch:
+            imported += await self._import_batch(batch, existing)
+        return imported
+
+    async def _import_batch(
+        self, batch: list[Stock], existing: dict[str, Stock]
+    ) -> int:
+        # 同じ商品が複数回あれば後のものを使う
+        stocks = {}
+        for stock in batch:
+            old = existing.get(stock.stock_id)
+            if stock.count is None:
+                stock = replace(stock, count=old.count if old is not None else 0)
+            stocks[stock.stock_id] = stock
+
+        await self._run(
+            self.backend.put_stocks, self.stocks_collection, list(stocks.values())
+        )
+
+        for stock in stocks.values():
+            old = existing.get(stock.stock_id)
+            if old is None:
+                self.events.record(stock.stock_id, "create", 0, 0)
+                old_count = 0
+            else:
+                self.totals.record(old.group, -old.count * (old.price or 0))
+                old_count = old.count
+            if stock.count != old_count:
+                self.events.record(
+                    stock.stock_id, "delta", stock.count - old_count, stock.count
+                )
+            self.totals.record(stock.group, stock.count * (stock.price or 0))
+
+            self.cache.put(stock)
+            self.search.put(stock)
+            self.buffer.update_stock(stock)
+            existing[stock.stock_id] = stock
+        return len(stocks)
+
+    async def close(self) -> None:
+        await self.buffer.close()
+        await self.events.close()
+        await self.rollups.close()
+        await self.totals.close()
+        self.cache.close()
+        self._executor.shutdown(wait=False)
+        # 共有しているストレージは作った側が閉じる
+        if self._owns_backend:
+            self.backend.close()
+
+    async def _adjust_stock(self, stock: Stock, delta: int) -> Stock:
+        count = await self._run_write(
+            self.backend.apply_delta, self.stocks_collection, stock.stock_id, delta
+        )
+        delta = self._actual_delta(stock.stock_id, delta, count)
+        self.cache.update_count(stock.stock_id, count)
+        self._record_change(stock.stock_id, delta, count, stock)
         return Stock(
-            detail=stock_data["detail"],
+            detail=stock.detail,
             stock_id=stock.stock_id,
-            count=stock_data["count"],
-            price=stock_data["price"],
-            group=stock_data["group"],
+            count=count,
+            price=stock.price,
+            group=stock.group,
         )
 
+    async def increment_stock(self, stock: Stock) -> Stock:
+        return await self._adjust_stock(stock, stock.count)
+
+    async def decrease_stock(self, stock: Stock) -> Stock:
+        return await self._adjust_stock(stock, -stock.count)
+
     async def add_stock(self, stock: Stock) -> Stock:
         stock_id = utils.generate_id(stock.group + stock.detail)
-        self.set(
-            collection="stocks",
-            document=stock_id,
-            data={
-                "group": stock.group,
-                "detail": stock.detail,
-                "count": 0,
-                "price": stock.price,
-            },
+        # 同じ商品を追加し直すと個数が0に戻り、売上の合計とずれるので受け付けない
+        existing = await self._run(
+            self.backend.get_stock, self.stocks_collection, stock_id
         )
-        return Stock(
+        if existing is not None:
+            raise ValueError(
+                f"The stock {stock.group} ({stock.detail}) already exists."
+            )
+        new_stock = Stock(
             detail=stock.detail,
             stock_id=stock_id,
             count=0,
             price=stock.price,
             group=stock.group,
         )
+        await self._run(self.backend.put_stock, self.stocks_collection, new_stock)
+        self.cache.put(new_stock)
+        self.search.put(new_stock)
+        self.events.record(stock_id, "create", 0, 0)
+        self.totals.record(new_stock.group, 0)
+        return new_stock
 
     async def delete_stock(self, stock_id: str) -> None:
-        self.delete(collection="stocks", document=stock_id)
+        # 売上の合計から差し引くため、削除する前の個数を読んでおく
+        # 存在しない商品なら何も変えずに KeyError にする
+        stock = await self._run(
+            self.backend.get_stock, self.stocks_collection, stock_id
+        )
+        if stock is None:
+            raise KeyError(stock_id)
+        self.buffer.forget(stock_id)
+        self.cache.remove(stock_id)
+        self.search.remove(stock_id)
+        await self._run(self.backend.delete_stock, self.stocks_collection, stock_id)
+        self.events.record(stock_id, "delete", 0, 0)
+        self.totals.record(stock.group, -stock.count * (stock.price or 0))
 
     async def get_stock(self, stock_id: str) -> Stock:
-        stock_data = self.get(collection="stocks", document=stock_id)
-        return Stock(
-            detail=stock_data["detail"],
-            stock_id=stock_id,
-            count=stock_data["count"],
-            price=stock_data["price"],
-            group=stock_data["group"],
+        # キャッシュにあればネットワークを使わずに返す
+        stock = self.cache.lookup(stock_id)
+        if stock is not None:
+            return stock
+
+        stock = await self._run(
+            self.backend.get_stock, self.stocks_collection, stock_id
         )
+        if stock is None:
+            raise KeyError(stock_id)
+        self.cache.put(stock)
+        return stock
 
-    async def get_all_stock(self) -> list[Stock]:
-        data = self.get(collection="stocks", document=None)
-        result = []
-        for stock_id, stock_data in data.items():
-            result.append(
-                Stock(
-                    detail=stock_data["detail"],
-                    stock_id=stock_id,
-                    count=stock_data["count"],
-                    price=stock_data["price"],
-                    group=stock_data["group"],
-                )
+    async def get_stock_page(
+        self, after: tuple[str, str] | None, limit: int
+    ) -> list[Stock]:
+        # キャッシュが新しければそこから、なければカーソルを使ったクエリで1ページ分だけ読む
+        if self.cache.is_fresh():
+            self.cache.hits += 1
+            stocks = self.cache.page(after, limit)
+        else:
+            self.cache.misses += 1
+            stocks = await self._run(
+                self.backend.get_stock_page, self.stocks_collection, after, limit
             )
+        # まだ書き込んでいないクリックも反映した個数を表示する
+        return [self.buffer.projected(stock.stock_id) or stock for stock in stocks]
 
-        return result
+    async def get_all_stock(self) -> list[Stock]:
+        if self.cache.is_fresh():
+            self.cache.hits += 1
+        else:
+            self.cache.misses += 1
+            await self._ensure_cache()
+        # 並べ替えや描画でも、まだ書き込んでいないクリックを反映した個数を使う
+        return [
+            self.buffer.projected(stock.stock_id) or stock
+            for stock in self.cache.values()
+        ]
@@ -7,10 +7,13 @@ class EmbedManager:
     def get_embed(self, detail: str, count: int, id: str, price: int, group: str) -> discord.Embed:
         embed = discord.Embed(
             title=detail if not price else f'{group}（{detail}） -  ¥{price}',
-            description=f'個数: **{count}**個\n売上: **{count * price}**円',
+            description=self.get_description(count, price),
             color=discord.Color.blurple()
         )
         
         embed.set_footer(text=id)
         
         return embed
+
+    def get_description(self, count: int, price: int) -> str:
+        return f'個数: **{count}**個\n売上: **{count * price}**円'
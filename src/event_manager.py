@@ -0,0 +1,293 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING
+
+from storage_manager import StorageBackend
+from utils import ERROR, INFO
+
+if TYPE_CHECKING:
+    from db_manager import DBManager
+
+
+# イベントの保存先("backend" はdbのイベント用コレクション、"file" はローカルのファイル、"off" は記録しない)
+EVENT_LOG = os.getenv("DS_BOT_STOCK_CONTROL_EVENT_LOG", "backend")
+EVENT_LOG_PATH = os.getenv("DS_BOT_STOCK_CONTROL_EVENT_LOG_PATH", "stock_events.jsonl")
+# イベントをまとめて書き込むまでの秒数と、溜まったイベント数の上限
+EVENT_FLUSH_INTERVAL = float(
+    os.getenv("DS_BOT_STOCK_CONTROL_EVENT_FLUSH_INTERVAL", "5.0")
+)
+EVENT_FLUSH_BATCH_SIZE = int(
+    os.getenv("DS_BOT_STOCK_CONTROL_EVENT_FLUSH_BATCH_SIZE", "200")
+)
+# イベントを商品ごとのスナップショットにまとめる間隔(秒)。0ならまとめない
+EVENT_COMPACT_INTERVAL = float(
+    os.getenv("DS_BOT_STOCK_CONTROL_EVENT_COMPACT_INTERVAL", "3600")
+)
+
+
+@dataclass
+class StockEvent:
+    seq: int
+    stock_id: str
+    kind: str  # "create" | "delta" | "delete"
+    delta: int  # 要求された差分(個数は0未満にならないように切り詰められる)
+    count: int  # 変更後の個数
+    at: float
+
+
+def fold_events(
+    snapshots: dict[str, dict], events: list[dict]
+) -> dict[str, dict | None]:
+    # スナップショットにイベントを順に適用し、変わった商品のスナップショットを返す(削除された商品は None)
+    changed: dict[str, dict | None] = {}
+    for event in events:
+        stock_id = event["stock_id"]
+        snapshot = changed[stock_id] if stock_id in changed else snapshots.get(stock_id)
+        # 途中まで反映済みのスナップショットに同じイベントを二重に適用しない
+        if snapshot is not None and event["seq"] <= snapshot["seq"]:
+            continue
+
+        if event["kind"] == "delete":
+            changed[stock_id] = None
+            continue
+        if event["kind"] == "create":
+            count = 0
+        elif snapshot is None:
+            # ログを始める前からある商品は、最初のイベントの変更後の個数から始める
+            count = event["count"]
+        else:
+            count = max(snapshot["count"] + event["delta"], 0)
+        changed[stock_id] = {"count": count, "seq": event["seq"], "at": event["at"]}
+    return changed
+
+
+class BackendEventStore:
+    def __init__(self, backend: StorageBackend, collection: str = "events"):
+        self.backend = backend
+        self.collection = collection
+
+    def append(self, events: list[dict]) -> None:
+        self.backend.append_events(self.collection, events)
+
+    def read(self, after: int) -> list[dict]:
+        return self.backend.get_events(self.collection, after)
+
+    def truncate(self, until: int) -> None:
+        self.backend.delete_events(self.collection, until)
+
+
+class FileEventStore:
+    # 1行1イベントのJSONで追記する
+    def __init__(self, path: str = EVENT_LOG_PATH):
+        self.path = path
+
+    def append(self, events: list[dict]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self, after: int) -> list[dict]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        return sorted(
+            (event for event in events if event["seq"] > after),
+            key=lambda event: event["seq"],
+        )
+
+    def truncate(self, until: int) -> None:
+        # まとめ終わったイベントを除いたファイルを書き出してから置き換える
+        events = self.read(until)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+
+def namespaced_path(namespace: str, path: str = EVENT_LOG_PATH) -> str:
+    # stock_events.jsonl -> stock_events.<namespace>.jsonl
+    if not namespace:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{namespace}{ext}"
+
+
+def create_event_store(
+    backend: StorageBackend,
+    name: str = EVENT_LOG,
+    collection: str = "events",
+    path: str = EVENT_LOG_PATH,
+):
+    if name == "backend":
+        return BackendEventStore(backend, collection)
+    if name == "file":
+        return FileEventStore(path)
+    if name == "off":
+        return None
+    raise ValueError(f"Unknown event log: {name}")
+
+
+class EventLog:
+    # 個数の変更をイベントとして追記し、一定間隔でスナップショットにまとめる
+    # 個数は「最後のスナップショット + それ以降のイベント」から組み立て直せる
+    def __init__(
+        self,
+        db_manager: "DBManager",
+        store: BackendEventStore | FileEventStore | None,
+        flush_interval: float = EVENT_FLUSH_INTERVAL,
+        batch_size: int = EVENT_FLUSH_BATCH_SIZE,
+        compact_interval: float = EVENT_COMPACT_INTERVAL,
+    ):
+        self.db_manager = db_manager
+        self.store = store
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.compact_interval = compact_interval
+        self.snapshots_collection = db_manager.collection("stock_snapshots")
+        self.log_collection = db_manager.collection("event_log")
+        self._pending: list[StockEvent] = []
+        self._last_seq = 0
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._compacted_at = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.store is not None
+
+    def _next_seq(self) -> int:
+        # 再起動をまたいでも増え続けるように時刻(ナノ秒)を元にする
+        self._last_seq = max(time.time_ns(), self._last_seq + 1)
+        return self._last_seq
+
+    def record(self, stock_id: str, kind: str, delta: int, count: int) -> None:
+        if not self.enabled:
+            return
+        self._pending.append(
+            StockEvent(
+                seq=self._next_seq(),
+                stock_id=stock_id,
+                kind=kind,
+                delta=delta,
+                count=count,
+                at=time.time(),
+            )
+        )
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await asyncio.shield(self.flush())
+
+            if (
+                self.compact_interval > 0
+                and time.monotonic() - self._compacted_at >= self.compact_interval
+            ):
+                await asyncio.shield(self.compact())
+
+    async def flush(self) -> None:
+        async with self._lock:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        if not self._pending:
+            return
+        events, self._pending = self._pending, []
+        try:
+            await self.db_manager._run(
+                self.store.append, [asdict(event) for event in events]
+            )
+        except Exception as e:
+            logging.error(ERROR + f"Error occurred while writing stock events:\n{e}")
+            # 書き込めなかったイベントは順序を保ったまま次回に持ち越す
+            self._pending = events + self._pending
+
+    async def compact(self) -> int:
+        if not self.enabled:
+            return 0
+        async with self._lock:
+            await self._flush()
+            self._compacted_at = time.monotonic()
+            try:
+                folded = await self.db_manager._run(self._compact)
+            except Exception as e:
+                logging.error(
+                    ERROR + f"Error occurred while compacting stock events:\n{e}"
+                )
+                return 0
+        if folded:
+            logging.info(INFO + f"Compacted {folded} stock events into snapshots.")
+        return folded
+
+    def _load(self) -> tuple[dict[str, dict], int, list[dict]]:
+        backend = self.db_manager.backend
+        snapshots = backend.get(self.snapshots_collection, None) or {}
+        watermark = (backend.get(self.log_collection, "compaction") or {}).get(
+            "seq", 0
+        )
+        return snapshots, watermark, self.store.read(watermark)
+
+    def _compact(self) -> int:
+        backend = self.db_manager.backend
+        snapshots, _, events = self._load()
+        if not events:
+            return 0
+
+        # スナップショット、まとめ終わった位置、イベントの削除の順に書き込む
+        # 途中で失敗しても、スナップショットの seq より前のイベントは次回に読み飛ばされる
+        for stock_id, snapshot in fold_events(snapshots, events).items():
+            if snapshot is None:
+                backend.delete(self.snapshots_collection, stock_id)
+            else:
+                backend.set(self.snapshots_collection, stock_id, snapshot)
+        until = events[-1]["seq"]
+        backend.set(
+            self.log_collection, "compaction", {"seq": until, "at": time.time()}
+        )
+        self.store.truncate(until)
+        return len(events)
+
+    def _rebuild(self) -> dict[str, int]:
+        snapshots, _, events = self._load()
+        snapshots.update(fold_events(snapshots, events))
+        return {
+            stock_id: snapshot["count"]
+            for stock_id, snapshot in snapshots.items()
+            if snapshot is not None
+        }
+
+    async def rebuild(self) -> dict[str, int]:
+        # 最後のスナップショットとそれ以降のイベントから各商品の個数を求める
+        async with self._lock:
+            await self._flush()
+            return await self.db_manager._run(self._rebuild)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.enabled:
+            await self.flush()
@@ -1,12 +1,21 @@
 import asyncio
+import hashlib
+import json
 import logging
 import os
+import time
+from typing import Literal
 
-import db_manager
 import discord
+import storage_manager
 from discord.app_commands import locale_str
 
+from catalog_manager import download_catalog, read_catalog, write_catalog
+from channel_manager import ChannelRegistry, StockChannel
 from embed_manager import EmbedManager
+from metrics_manager import metrics
+from render_manager import create_renderer
+from rollup_manager import summarize
 from utils import (
     INFO,
     ERROR,
@@ -20,71 +29,172 @@ from utils import (
     bold,
     CommandsTranslator,
     Stock,
+    parse_adjustments,
+)
+from view_manager import (
+    BoardDecreaseButton,
+    BoardIncreaseButton,
+    BoardSelect,
+    DecreaseButton,
+    IncreaseButton,
+    QuantityButton,
+    StockListView,
 )
-from view_manager import StockManageView
 
 
 intents = discord.Intents.all()
 
 logging.basicConfig(level=logging.INFO, format=FORMAT, datefmt=DATEFORMAT)
 
+# シャードの総数と、このプロセスが受け持つシャード(カンマ区切り)。未設定なら自動で決める
+SHARD_COUNT = os.getenv("DS_BOT_STOCK_CONTROL_SHARD_COUNT")
+SHARD_IDS = os.getenv("DS_BOT_STOCK_CONTROL_SHARD_IDS")
+# コマンドの定義が変わっていなくても起動時に同期する
+FORCE_SYNC = os.getenv("DS_BOT_STOCK_CONTROL_FORCE_SYNC", "0") == "1"
 
-class Client(discord.Client):
-    def __init__(self):
-        super().__init__(intents=intents)
-        self.db_manager = db_manager.DBManager()
-        self.embed_manager = EmbedManager()
-
-    async def on_ready(self):
-        await self.sync_commands()
 
-        self.target_guild = self.get_guild(int(os.getenv("STOCK_CONTROL_GUILD")))
-        self.target_channel = self.target_guild.get_channel(
-            int(os.getenv("STOCK_CONTROL_CHANNEL"))
+class Client(discord.AutoShardedClient):
+    def __init__(self):
+        # 受け持つシャードを指定する場合は、シャードの総数も必要
+        if SHARD_IDS and not SHARD_COUNT:
+            raise ValueError(
+                "DS_BOT_STOCK_CONTROL_SHARD_IDS requires DS_BOT_STOCK_CONTROL_SHARD_COUNT."
+            )
+        super().__init__(
+            intents=intents,
+            # Discord APIの呼び出しをルートごとに数える
+            http_trace=metrics.http_trace(),
+            shard_count=int(SHARD_COUNT) if SHARD_COUNT else None,
+            shard_ids=(
+                [int(shard_id) for shard_id in SHARD_IDS.split(",")]
+                if SHARD_IDS
+                else None
+            ),
         )
+        # チャンネルごとの商品一覧。ストレージへの接続は1つを共有する
+        self.channels = ChannelRegistry(storage_manager.create_backend())
+        self.embed_manager = EmbedManager()
+        self._connecting: asyncio.Task | None = None
+        self._startup: asyncio.Task | None = None
 
-        # クライアント再起動時は前のメッセージを削除
-        async for message in self.target_channel.history(
-            limit=200
-        ):  # 仕様上200件までしか取得できない
-            await message.delete()
-
-        view = StockManageView()
-
-        all_stocks = await self.db_manager.get_all_stock()
-        sorted_stocks = await sort_stocks_by_group(all_stocks)
-
-        # ストック(商品)ごとにメッセージを送信
-        try:
-            for stock in sorted_stocks:
-                embed = self.embed_manager.get_embed(
-                    stock.detail,
-                    stock.count,
-                    stock.stock_id,
-                    price=stock.price,
-                    group=stock.group,
-                )
-                message = await self.target_channel.send(
-                    embed=embed, view=view, silent=True
-                )
-                await asyncio.sleep(0.5)
-                await self.target_channel.send("‎", silent=True)
-                await asyncio.sleep(0.5)
-        except Exception as e:
-            logging.error(ERROR + f"Error occurred while sending stock messages:\n{e}")
+    def stock_channel(self, interaction: discord.Interaction) -> StockChannel | None:
+        return self.channels.resolve(interaction.guild_id, interaction.channel_id)
 
-        logging.info(SUCCESS + "All stock messages have been sent.")
+    async def on_ready(self):
         logging.info(
             INFO + f"Logged in as {green(self.user.name)} ({blue(self.user.id)})"
         )
         logging.info(INFO + f"Connected to {green(len(self.guilds))} guilds")
+        # on_ready は再接続のたびに呼ばれるので、同期と読み込みは最初の1回だけ行う
+        if self._startup is not None:
+            return
+        # 読み込みの完了を待たずにボタンを受け付ける(読み込み中のチャンネルはそう答える)
+        self._startup = asyncio.create_task(self.start_up())
+
+    async def start_up(self) -> None:
+        # チャンネルごとに並行して読み込み、1つのチャンネルの失敗が他を止めないようにする
+        # コマンドの同期もチャンネルの読み込みを待たせないよう並行して行う
+        sync_result, *results = await asyncio.gather(
+            self.sync_commands(),
+            *(self.load_channel(stock_channel) for stock_channel in self.channels),
+            return_exceptions=True,
+        )
+        if isinstance(sync_result, Exception):
+            logging.error(
+                ERROR + f"Error occurred while syncing commands:\n{sync_result}"
+            )
+        for stock_channel, result in zip(self.channels, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    ERROR
+                    + f"Error occurred while sending stock messages to {stock_channel.channel_id}:\n{result}"
+                )
+
+        logging.info(SUCCESS + "All stock messages have been sent.")
         logging.info(INFO + bold("Bot is ready."))
 
+    async def load_channel(self, stock_channel: StockChannel) -> None:
+        # このプロセスのシャードにないサーバーのチャンネルは、受け持つプロセスが読み込む
+        guild = self.get_guild(stock_channel.guild_id)
+        if guild is None:
+            return
+        channel = guild.get_channel(stock_channel.channel_id)
+        db_manager = stock_channel.db_manager
+
+        renderer = create_renderer(channel, self.embed_manager, db_manager)
+        # 書き込み後の値が表示とずれていたら、キューを通してメッセージを直す
+        db_manager.buffer.on_flushed = renderer.update
+
+        all_stocks = await db_manager.get_all_stock()
+        sorted_stocks = await sort_stocks_by_group(all_stocks)
+        # 売上の合計を読み込んでおき、コマンドではすぐに答えられるようにする
+        await db_manager.totals.load()
+        stock_channel.renderer = renderer
+
+        # 前回のメッセージを使い回し、変わった商品のメッセージだけを送信・編集する
+        await renderer.restore(sorted_stocks)
+        logging.info(INFO + f"Loaded {green(channel)} ({len(all_stocks)} stocks).")
+
+    async def close(self) -> None:
+        for task in (self._connecting, self._startup):
+            if task is not None and not task.done():
+                task.cancel()
+        # 終了時にメモリ上に溜まっている差分を書き込む
+        await self.channels.close()
+        await metrics.close()
+        await super().close()
+
     async def setup_hook(self) -> None:
         await tree.set_translator(CommandsTranslator())
+        # ボタンのcustom_idから商品を復元するので、再起動前のメッセージのボタンもそのまま動く
+        self.add_dynamic_items(
+            IncreaseButton,
+            DecreaseButton,
+            QuantityButton,
+            BoardSelect,
+            BoardIncreaseButton,
+            BoardDecreaseButton,
+        )
+        # イベントループの遅れの計測と、設定されていればメトリクスのエンドポイントを始める
+        await metrics.start()
+        # ゲートウェイへの接続と並行して、保存先に接続しておく
+        self._connecting = asyncio.create_task(self.connect_storage())
+
+    async def connect_storage(self) -> None:
+        try:
+            await self.channels.connect()
+        except Exception as e:
+            # 接続は最初の読み書きのときにもう一度試みられる
+            logging.error(ERROR + f"Error occurred while connecting to storage:\n{e}")
+
+    async def commands_hash(self) -> str:
+        # 翻訳も含めて、Discordに送るコマンドの定義そのもののハッシュ
+        translator = tree.translator
+        payload = [
+            (
+                await command.get_translated_payload(tree, translator)
+                if translator
+                else command.to_dict(tree)
+            )
+            for command in tree.get_commands()
+        ]
+        return hashlib.sha256(
+            json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()
+        ).hexdigest()
 
     async def sync_commands(self) -> None:
+        # 同期はレート制限が厳しいので、前回の同期から定義が変わったときだけ行う
+        db_manager = self.channels.db_manager
+        digest = await self.commands_hash()
+        if (
+            not FORCE_SYNC
+            and await db_manager.get_commands_hash(self.application_id) == digest
+        ):
+            logging.info(INFO + "Commands are up to date.")
+            return
         await tree.sync()
+        await db_manager.save_commands_hash(self.application_id, digest)
+        logging.info(SUCCESS + "Commands have been synced.")
 
     async def on_app_command_completion(
         self,
@@ -98,6 +208,13 @@ class Client(discord.Client):
         user_name = blue(exec_user.name)
         user_id = blue(exec_user.id)
         exec_command = green(command.name)
+        started = interaction.extras.get("started")
+        if started is not None:
+            metrics.observe(
+                "interaction_seconds",
+                f"command:{command.name}",
+                time.perf_counter() - started,
+            )
         logging.info(
             INFO
             + f"Command executed by {user_name}({user_id}): {exec_command} in {exec_guild}({exec_channel})"
@@ -116,8 +233,44 @@ async def sort_stocks_by_group(all_stocks: list[Stock]) -> list[Stock]:
     return sorted(all_stocks, key=lambda x: x.group)
 
 
+class CommandTree(discord.app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # コマンドの処理時間を測るために受け付けた時刻を残しておく
+        interaction.extras["started"] = time.perf_counter()
+        return True
+
+    async def on_error(
+        self,
+        interaction: discord.Interaction,
+        error: discord.app_commands.AppCommandError,
+    ) -> None:
+        command = interaction.command.name if interaction.command else "unknown"
+        metrics.increment("command_errors_total", command)
+        await super().on_error(interaction, error)
+
+
 client = Client()
-tree = discord.app_commands.CommandTree(client=client)
+tree = CommandTree(client=client)
+
+
+async def get_stock_channel(
+    interaction: discord.Interaction,
+) -> StockChannel | None:
+    # コマンドを実行したチャンネル(または、サーバーに1つだけある商品一覧)を返す
+    stock_channel = client.stock_channel(interaction)
+    if stock_channel is None:
+        await interaction.response.send_message(
+            "このチャンネルでは商品を管理していません", ephemeral=True
+        )
+        return None
+    if not stock_channel.ready:
+        # 起動直後はチャンネルを裏で読み込んでいる
+        await interaction.response.send_message(
+            "商品一覧を読み込んでいます。少し待ってからもう一度実行してください",
+            ephemeral=True,
+        )
+        return None
+    return stock_channel
 
 
 @tree.command(name=locale_str("ping"), description=locale_str("Ping the bot."))
@@ -134,14 +287,24 @@ async def ping(interaction: discord.Interaction):
 async def add_stock(
     interaction: discord.Interaction, group: str, detail: str, price: int
 ):
-    db_manager = client.db_manager
-    stock = await db_manager.add_stock(Stock(detail=detail, price=price, group=group))
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
 
-    embed = client.embed_manager.get_embed(
-        stock.detail, stock.count, stock.stock_id, price=stock.price, group=stock.group
-    )
-    await client.target_channel.send(embed=embed, view=StockManageView(), silent=True)
-    await interaction.response.send_message("商品が追加されました", ephemeral=True)
+    # dbへの書き込みを待たずに応答しておく
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    db_manager = stock_channel.db_manager
+    try:
+        stock = await db_manager.add_stock(
+            Stock(detail=detail, price=price, group=group)
+        )
+    except ValueError:
+        await interaction.followup.send("同じ商品がすでにあります", ephemeral=True)
+        return
+
+    await stock_channel.renderer.append(stock)
+    await interaction.followup.send("商品が追加されました", ephemeral=True)
 
 
 @tree.command(
@@ -149,10 +312,147 @@ async def add_stock(
     description=locale_str("Remove a stock from the stock list."),
 )
 async def delete_stock(interaction: discord.Interaction, stock_id: str):
-    db_manager = client.db_manager
-    await db_manager.delete_stock(stock_id)
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    db_manager = stock_channel.db_manager
+    try:
+        await db_manager.delete_stock(stock_id)
+    except KeyError:
+        await interaction.followup.send("商品が見つかりません", ephemeral=True)
+        return
+    await stock_channel.renderer.remove(stock_id)
+
+    await interaction.followup.send("商品は削除されました", ephemeral=True)
+
+
+@tree.command(
+    name=locale_str("adjust_stock"),
+    description=locale_str("Change a stock count by any amount."),
+)
+async def adjust_stock(interaction: discord.Interaction, stock_id: str, delta: int):
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    # ボタンと同じくバッファを通して書き込む(0未満になる場合は切り詰めずにエラーにする)
+    db_manager = stock_channel.db_manager
+    try:
+        stock = await db_manager.queue_adjust(stock_id, delta, clamp=False)
+    except KeyError:
+        await interaction.followup.send("商品が見つかりません", ephemeral=True)
+        return
+    except ValueError as e:
+        await interaction.followup.send(str(e), ephemeral=True)
+        return
+
+    await stock_channel.renderer.update([stock])
+    await interaction.followup.send(
+        f"{stock.group} ({stock.detail}) の個数を{delta:+d}しました(現在{stock.count}個)",
+        ephemeral=True,
+    )
+
 
-    await interaction.response.send_message("商品は削除されました", ephemeral=True)
+@tree.command(
+    name=locale_str("bulk_adjust_stock"),
+    description=locale_str(
+        "Change many stock counts at once from stock_id:delta pairs or a CSV file."
+    ),
+)
+async def bulk_adjust_stock(
+    interaction: discord.Interaction,
+    pairs: str | None = None,
+    file: discord.Attachment | None = None,
+):
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    text = pairs or ""
+    if file is not None:
+        text += "\n" + (await file.read()).decode("utf-8-sig")
+    adjustments = parse_adjustments(text)
+    if not adjustments:
+        await interaction.followup.send(
+            "stock_id:増減数 の組が見つかりません", ephemeral=True
+        )
+        return
+
+    # すべて検証してから1回の書き込みで反映するので、1件でもエラーなら何も変わらない
+    db_manager = stock_channel.db_manager
+    try:
+        stocks = await db_manager.apply_adjustments(adjustments)
+    except KeyError as e:
+        await interaction.followup.send(
+            f"商品が見つかりません: {e.args[0]}", ephemeral=True
+        )
+        return
+    except ValueError as e:
+        await interaction.followup.send(str(e), ephemeral=True)
+        return
+
+    await stock_channel.renderer.update(stocks)
+    await interaction.followup.send(
+        f"{len(stocks)}件の商品の個数を変更しました", ephemeral=True
+    )
+
+
+@tree.command(
+    name=locale_str("import_stocks"),
+    description=locale_str("Add or update stocks from a CSV or JSON file."),
+)
+async def import_stocks(interaction: discord.Interaction, file: discord.Attachment):
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    # 1行ずつ読みながらまとめて書き込み、チャンネルは最後に1回だけ描画する
+    db_manager = stock_channel.db_manager
+    try:
+        with await download_catalog(file.url) as data:
+            imported = await db_manager.import_stocks(read_catalog(data, file.filename))
+    except ValueError as e:
+        await interaction.followup.send(
+            f"読み込めませんでした(途中までの商品は追加されています): {e}",
+            ephemeral=True,
+        )
+        return
+
+    all_stocks = await db_manager.get_all_stock()
+    await stock_channel.renderer.render(await sort_stocks_by_group(all_stocks))
+    await interaction.followup.send(
+        f"{imported}件の商品を読み込みました", ephemeral=True
+    )
+
+
+@tree.command(
+    name=locale_str("export_stocks"),
+    description=locale_str("Export all stocks as a CSV or JSON file."),
+)
+async def export_stocks(
+    interaction: discord.Interaction, format: Literal["csv", "json"] = "csv"
+):
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    db_manager = stock_channel.db_manager
+    all_stocks = await sort_stocks_by_group(await db_manager.get_all_stock())
+    with write_catalog(all_stocks, format) as f:
+        await interaction.followup.send(
+            file=discord.File(f, filename=f"stocks.{format}"), ephemeral=True
+        )
 
 
 @tree.command(
@@ -160,122 +460,321 @@ async def delete_stock(interaction: discord.Interaction, stock_id: str):
     description=locale_str("Get all stocks in the stock list."),
 )
 async def get_all_stocks(interaction: discord.Interaction):
-    db_manager = client.db_manager
-    all_stocks = await db_manager.get_all_stock()
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
 
-    stock_list = "\n".join(
-        [
-            f"{stock.detail}({stock.price}) - 売上: {stock.count}個"
-            for stock in all_stocks
-        ]
-    )
-    await interaction.response.send_message(stock_list, ephemeral=True)
+    # 読み込みが3秒の期限を超えないよう、先に応答だけ返す
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    # 1ページ分だけを読み込んで表示し、残りはボタンで開いたときに読む
+    view = StockListView(stock_channel.db_manager)
+    await view.load()
+    await interaction.followup.send(embed=view.get_embed(), view=view, ephemeral=True)
+
+
+# 売上の検証で表示する、個数がイベントの記録と異なる商品の数
+DRIFT_MAX_ROWS = 20
 
 
 @tree.command(
     name=locale_str("calc_total_sales"),
     description=locale_str("Calculate total sales."),
 )
-async def calc_total_sales(interaction: discord.Interaction):
-    # すべての商品を取得
-    db_manager = client.db_manager
-    all_stocks = await db_manager.get_all_stock()
-
-    # 売上を計算
-    sales = {}
-    for stock in all_stocks:
-        sales[f"{stock.group} ({stock.detail})"] = stock.count * stock.price
-
-    # 総売上を計算
-    total_sales = sum(sales.values())
-    sales["total_sales"] = total_sales
+async def calc_total_sales(interaction: discord.Interaction, verify: bool = False):
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
+
+    # 個数の変更ごとに加算している合計を使うので、商品一覧は読まない
+    db_manager = stock_channel.db_manager
+    if verify:
+        # 全商品から計算し直し、ずれていれば計算し直した値に揃える
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        drift = await db_manager.totals.verify()
+        # 個数の変更履歴を記録している場合は、履歴から組み立て直した個数とも比べる
+        count_drift = await db_manager.reconcile() if db_manager.events.enabled else {}
+    total_sales, sales = await db_manager.totals.snapshot()
 
     # 売上リストを作成
     sales_list = "\n- ".join(
         [
-            f"{key}:\n    - {value}円"
-            for key, value in sales.items()
-            if key != "total_sales"
+            f"{group}:\n    - {value}円"
+            for group, value in sorted(sales.items(), key=lambda x: x[1], reverse=True)
         ]
     )
     sales_list += f"\n\n**総売上: __{total_sales}__円**"
 
+    if verify:
+        if drift:
+            sales_list += "\n\n**ずれを修正しました:**\n" + "\n".join(
+                [
+                    f"- {label}: {running}円 → {actual}円"
+                    for label, (running, actual) in drift.items()
+                ]
+            )
+        else:
+            sales_list += "\n\nずれはありません"
+        if count_drift:
+            lines = []
+            shown = list(count_drift.items())[:DRIFT_MAX_ROWS]
+            for stock_id, (stored, rebuilt) in shown:
+                stock = db_manager.cache.peek(stock_id)
+                label = f"{stock.group} ({stock.detail})" if stock else stock_id
+                saved = f"{stored}個" if stored is not None else "削除済み"
+                lines.append(f"- {label}: {saved} (履歴では{rebuilt}個)")
+            if len(count_drift) > DRIFT_MAX_ROWS:
+                lines.append(f"ほか{len(count_drift) - DRIFT_MAX_ROWS}件")
+            sales_list += "\n\n**個数が変更履歴と異なる商品:**\n" + "\n".join(lines)
+
     # メッセージを送信
     embed = discord.Embed(
         title="売上一覧", description=sales_list, color=discord.Color.green()
     )
+    if verify:
+        await interaction.followup.send(embed=embed, ephemeral=True)
+    else:
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+@tree.command(
+    name=locale_str("cache_stats"),
+    description=locale_str("Show stock cache statistics."),
+)
+async def cache_stats(interaction: discord.Interaction, refresh: bool = False):
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
+
+    db_manager = stock_channel.db_manager
+    if refresh:
+        await db_manager.refresh_cache()
+
+    stats = db_manager.cache.stats()
+    age = f"{stats['age']:.1f}秒" if stats["age"] is not None else "未読み込み"
+    embed = discord.Embed(
+        title="キャッシュの状態",
+        description=(
+            f"商品数: **{stats['size']}**\n"
+            f"ヒット: **{stats['hits']}**\n"
+            f"ミス: **{stats['misses']}**\n"
+            f"期限切れ: **{stats['stale']}**\n"
+            f"リスナー: **{'有効' if stats['listening'] else '無効'}**\n"
+            f"最終読み込み: **{age}**"
+        ),
+        color=discord.Color.blurple(),
+    )
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 
-# ! ここからのsortコマンドは、実質的には再生成コマンド
+SEARCH_MAX_RESULTS = 10
+AUTOCOMPLETE_MAX_CHOICES = 25
 
 
 @tree.command(
-    name=locale_str("sort_by_count"), description=locale_str("Sort stocks by count.")
+    name=locale_str("search_stock"),
+    description=locale_str(
+        "Search a stock from the stock list and return messge link."
+    ),
 )
-async def sort_by_count(interaction: discord.Interaction):
-    # 商品を個数順にソート
-    db_manager = client.db_manager
-    all_stocks = await db_manager.get_all_stock()
-    sorted_stocks = await sort_stocks_by_count(all_stocks)
+async def search_stock(interaction: discord.Interaction, query: str):
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
+
+    # メモリ上のインデックスを引くだけで、dbには問い合わせない
+    db_manager = stock_channel.db_manager
+    results = db_manager.search.search(query, SEARCH_MAX_RESULTS)
+    if not results:
+        await interaction.response.send_message(
+            "商品が見つかりませんでした", ephemeral=True
+        )
+        return
 
-    await interaction.response.send_message(
-        "並べ替えています...", ephemeral=True, delete_after=15
+    lines = []
+    for stock_id, label in results:
+        url = stock_channel.renderer.jump_url(stock_id)
+        lines.append(f"- [{label}]({url})" if url else f"- {label}")
+    embed = discord.Embed(
+        title=f"「{query}」の検索結果",
+        description="\n".join(lines),
+        color=discord.Color.blurple(),
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+@delete_stock.autocomplete("stock_id")
+@adjust_stock.autocomplete("stock_id")
+async def stock_id_autocomplete(
+    interaction: discord.Interaction, current: str
+) -> list[discord.app_commands.Choice[str]]:
+    # メモリ上の並べ済みの一覧から引くので、商品数が多くても補完の期限に間に合う
+    stock_channel = client.stock_channel(interaction)
+    if stock_channel is None:
+        return []
+    results = stock_channel.db_manager.search.suggest(current, AUTOCOMPLETE_MAX_CHOICES)
+    return [
+        discord.app_commands.Choice(name=label[:100], value=stock_id)
+        for stock_id, label in results
+    ]
+
+
+@search_stock.autocomplete("query")
+async def search_query_autocomplete(
+    interaction: discord.Interaction, current: str
+) -> list[discord.app_commands.Choice[str]]:
+    stock_channel = client.stock_channel(interaction)
+    if stock_channel is None:
+        return []
+    results = stock_channel.db_manager.search.suggest(current, AUTOCOMPLETE_MAX_CHOICES)
+    return [
+        discord.app_commands.Choice(name=label[:100], value=label[:100])
+        for _, label in results
+    ]
+
+
+STATS_MAX_ROWS = 10
+
+
+def format_latencies(rows: list[tuple[str, int, float, float, float]]) -> str:
+    return "\n".join(
+        f"- {label or '全体'}: {count}回 / p50 {p50 * 1000:.0f}ms / p99 {p99 * 1000:.0f}ms"
+        for label, count, p50, p99, _ in rows[:STATS_MAX_ROWS]
     )
 
-    # メッセージを削除
-    async for message in client.target_channel.history(limit=200):
-        await message.delete()
-        await asyncio.sleep(0.5)
-
-    # ソートされた商品を送信
-    for stock in sorted_stocks:
-        embed = client.embed_manager.get_embed(
-            stock.detail,
-            stock.count,
-            stock.stock_id,
-            price=stock.price,
-            group=stock.group,
-        )
-        message = await client.target_channel.send(
-            embed=embed, view=StockManageView(), silent=True
+
+@tree.command(
+    name=locale_str("stats"),
+    description=locale_str("Show response times, database calls and rate limits."),
+)
+@discord.app_commands.default_permissions(administrator=True)
+async def stats(interaction: discord.Interaction):
+    # 混雑時に遅いのがdbなのかDiscordのレート制限なのかを見分けるための統計
+    lag = metrics.summary("event_loop_lag_seconds")
+    requests = dict(metrics.counter_values("discord_requests_total"))
+    rate_limited = metrics.counter_values("discord_rate_limited_total")
+
+    embed = discord.Embed(title="統計", color=discord.Color.blurple())
+    embed.add_field(
+        name="応答時間",
+        value=format_latencies(metrics.summary("interaction_seconds")) or "なし",
+        inline=False,
+    )
+    embed.add_field(
+        name="dbの呼び出し",
+        value=format_latencies(metrics.summary("db_call_seconds")) or "なし",
+        inline=False,
+    )
+    embed.add_field(
+        name="Discord API(429の回数)",
+        value="\n".join(
+            [
+                f"- {route}: {count}回 ({dict(rate_limited).get(route, 0)})"
+                for route, count in sorted(
+                    requests.items(), key=lambda x: x[1], reverse=True
+                )[:STATS_MAX_ROWS]
+            ]
         )
-        await client.target_channel.send("‎", silent=True)
-        await asyncio.sleep(0.5)
+        or "なし",
+        inline=False,
+    )
+    embed.add_field(
+        name="イベントループの遅れ",
+        value=(
+            f"p50 {lag[0][2] * 1000:.0f}ms / p99 {lag[0][3] * 1000:.0f}ms / "
+            f"最大 {lag[0][4] * 1000:.0f}ms"
+            if lag
+            else "なし"
+        ),
+        inline=False,
+    )
+    uptime = time.time() - metrics.started_at
+    embed.set_footer(
+        text=f"起動から{uptime / 3600:.1f}時間 / 429: {sum(c for _, c in rate_limited)}回"
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+
+REPORT_TITLES = {"hour": "時間帯別", "day": "日別", "group": "グループ別"}
+REPORT_MAX_ROWS = 48
 
 
 @tree.command(
-    name=locale_str("sort_by_price"), description=locale_str("Sort stocks by price.")
+    name=locale_str("sales_report"),
+    description=locale_str("Show sales by hour, day or group."),
 )
-async def sort_by_price(interaction: discord.Interaction):
-    # 商品を価格順にソート
-    db_manager = client.db_manager
+async def sales_report(
+    interaction: discord.Interaction,
+    days: discord.app_commands.Range[int, 1, 31] = 1,
+    by: Literal["hour", "day", "group"] = "group",
+):
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
+
+    await interaction.response.defer(ephemeral=True, thinking=True)
+
+    # 日ごとの集計ドキュメントだけを読む
+    db_manager = stock_channel.db_manager
+    report = summarize(await db_manager.rollups.read(days), by)
+
+    rows = report["rows"]
+    # 時間帯別は新しい方から表示しきれる分だけにする
+    if len(rows) > REPORT_MAX_ROWS:
+        rows = rows[-REPORT_MAX_ROWS:] if by == "hour" else rows[:REPORT_MAX_ROWS]
+    lines = [f"- {label}: {units}個 / {revenue}円" for label, units, revenue in rows]
+
+    peak = report["peak"]
+    summary = (
+        f"販売数: **{report['units']}**個\n"
+        f"売上: **{report['revenue']}**円\n"
+        f"販売ペース: **{report['velocity']:.1f}**個/時"
+    )
+    if peak is not None:
+        summary += f"\nピーク: **{peak[0]}** ({peak[1]}個)"
+
+    embed = discord.Embed(
+        title=f"売上レポート({REPORT_TITLES[by]}・直近{days}日)",
+        description=summary + "\n\n" + ("\n".join(lines) or "販売はありません"),
+        color=discord.Color.green(),
+    )
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+
+# ! ここからのsortコマンドは、実質的には再生成コマンド
+# 既存のメッセージを編集して並べ替えるので、削除と再送信は増減した分だけになる
+
+
+async def rerender(interaction: discord.Interaction, sort_func) -> None:
+    stock_channel = await get_stock_channel(interaction)
+    if stock_channel is None:
+        return
+
+    db_manager = stock_channel.db_manager
     all_stocks = await db_manager.get_all_stock()
-    sorted_stocks = await sort_stocks_by_price(all_stocks)
+    sorted_stocks = await sort_func(all_stocks)
 
     await interaction.response.send_message(
         "並べ替えています...", ephemeral=True, delete_after=15
     )
 
-    # メッセージを削除
-    async for message in client.target_channel.history(limit=200):
-        await message.delete()
-        await asyncio.sleep(0.5)
-
-    # ソートされた商品を送信
-    for stock in sorted_stocks:
-        embed = client.embed_manager.get_embed(
-            stock.detail,
-            stock.count,
-            stock.stock_id,
-            price=stock.price,
-            group=stock.group,
-        )
-        message = await client.target_channel.send(
-            embed=embed, view=StockManageView(), silent=True
-        )
-        await client.target_channel.send("‎", silent=True)
-        await asyncio.sleep(0.5)
+    await stock_channel.renderer.render(sorted_stocks)
+
+
+@tree.command(
+    name=locale_str("sort_by_count"), description=locale_str("Sort stocks by count.")
+)
+async def sort_by_count(interaction: discord.Interaction):
+    # 商品を個数順にソート
+    await rerender(interaction, sort_stocks_by_count)
+
+
+@tree.command(
+    name=locale_str("sort_by_price"), description=locale_str("Sort stocks by price.")
+)
+async def sort_by_price(interaction: discord.Interaction):
+    # 商品を価格順にソート
+    await rerender(interaction, sort_stocks_by_price)
 
 
 @tree.command(
@@ -283,33 +782,7 @@ async def sort_by_price(interaction: discord.Interaction):
 )
 async def sort_by_group(interaction: discord.Interaction):
     # 商品をグループ順にソート
-    db_manager = client.db_manager
-    all_stocks = await db_manager.get_all_stock()
-    sorted_stocks = await sort_stocks_by_group(all_stocks)
-
-    await interaction.response.send_message(
-        "並べ替えています...", ephemeral=True, delete_after=15
-    )
-
-    # メッセージを削除
-    async for message in client.target_channel.history(limit=200):
-        await message.delete()
-        await asyncio.sleep(0.5)
-
-    # ソートされた商品を送信
-    for stock in sorted_stocks:
-        embed = client.embed_manager.get_embed(
-            stock.detail,
-            stock.count,
-            stock.stock_id,
-            price=stock.price,
-            group=stock.group,
-        )
-        message = await client.target_channel.send(
-            embed=embed, view=StockManageView(), silent=True
-        )
-        await client.target_channel.send("‎", silent=True)
-        await asyncio.sleep(0.5)
+    await rerender(interaction, sort_stocks_by_group)
 
 
 if __name__ == "__main__":
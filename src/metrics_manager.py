@@ -0,0 +1,242 @@
+import asyncio
+import bisect
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+
+import aiohttp
+from aiohttp import web
+
+from utils import INFO, WARN
+
+
+# Prometheus形式のテキストを返すポート。0なら起動しない
+METRICS_PORT = int(os.getenv("DS_BOT_STOCK_CONTROL_METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("DS_BOT_STOCK_CONTROL_METRICS_HOST", "127.0.0.1")
+# イベントループの遅れを測る間隔(秒)
+LOOP_LAG_INTERVAL = float(os.getenv("DS_BOT_STOCK_CONTROL_LOOP_LAG_INTERVAL", "0.5"))
+# この遅れを超えたら警告を出す(秒)
+LOOP_LAG_WARN = 0.25
+# ヒストグラムの区切り(秒)
+HISTOGRAM_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# URLのIDやトークンをまとめ、同じ種類のAPIを1つのルートとして数える
+ROUTE_ID_PATTERN = re.compile(r"/\d{15,}")
+ROUTE_TOKEN_PATTERN = re.compile(r"/(interactions|webhooks)/\{id\}/[^/]+")
+ROUTE_PREFIX_PATTERN = re.compile(r"^/api/v\d+")
+
+
+class Histogram:
+    # 区切りごとの件数だけを持つ。記録は二分探索と加算のみ
+    def __init__(self, buckets: tuple[float, ...] = HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は最大の区切りを超えたもの
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        # q 番目の値が入る区切りの上端を返す(最大の区切りを超えた場合は最大値)
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+def route_name(method: str, path: str) -> str:
+    path = ROUTE_PREFIX_PATTERN.sub("", path)
+    path = ROUTE_ID_PATTERN.sub("/{id}", path)
+    path = ROUTE_TOKEN_PATTERN.sub(r"/\1/{id}/{token}", path)
+    return f"{method} {path}"
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_label(label: str, **extra: str) -> str:
+    labels = ({"label": label} if label else {}) | extra
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+class Metrics:
+    # 処理時間のヒストグラムと回数のカウンタを (名前, ラベル) ごとに持つ
+    def __init__(self):
+        self.histograms: dict[tuple[str, str], Histogram] = {}
+        self.counters: dict[tuple[str, str], int] = {}
+        self.started_at = time.time()
+        self._lag_task: asyncio.Task | None = None
+        self._runner: web.AppRunner | None = None
+
+    def observe(self, name: str, label: str, value: float) -> None:
+        histogram = self.histograms.get((name, label))
+        if histogram is None:
+            histogram = self.histograms[(name, label)] = Histogram()
+        histogram.observe(value)
+
+    def increment(self, name: str, label: str, amount: int = 1) -> None:
+        self.counters[(name, label)] = self.counters.get((name, label), 0) + amount
+
+    @contextmanager
+    def timer(self, name: str, label: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, label, time.perf_counter() - started)
+
+    def http_trace(self) -> aiohttp.TraceConfig:
+        # discord.py のHTTPクライアントに渡し、Discord APIの呼び出しをルートごとに数える
+        # 429はdiscord.pyが待ってから送り直すので、送り直した分も1回として数える
+        trace = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            context.started = time.perf_counter()
+
+        async def on_request_end(session, context, params):
+            route = route_name(params.method, params.url.path)
+            self.increment("discord_requests_total", route)
+            self.observe(
+                "discord_request_seconds", route, time.perf_counter() - context.started
+            )
+            if params.response.status == 429:
+                self.increment("discord_rate_limited_total", route)
+
+        async def on_request_exception(session, context, params):
+            self.increment(
+                "discord_request_errors_total",
+                route_name(params.method, params.url.path),
+            )
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        return trace
+
+    async def start(self, port: int = METRICS_PORT, host: str = METRICS_HOST) -> None:
+        if self._lag_task is None or self._lag_task.done():
+            self._lag_task = asyncio.create_task(self._sample_loop_lag())
+        if port and self._runner is None:
+            app = web.Application()
+            app.router.add_get("/metrics", self._handle_metrics)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, host, port).start()
+            logging.info(INFO + f"Serving metrics on http://{host}:{port}/metrics")
+
+    async def _sample_loop_lag(self, interval: float = LOOP_LAG_INTERVAL) -> None:
+        # 指定した時間だけ眠り、予定より遅れて起きた分をイベントループの遅れとする
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = max(time.perf_counter() - started - interval, 0.0)
+            self.observe("event_loop_lag_seconds", "", lag)
+            if lag > LOOP_LAG_WARN:
+                logging.warning(WARN + f"Event loop lagged {lag * 1000:.0f}ms.")
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain")
+
+    def render(self) -> str:
+        # Prometheusのテキスト形式に書き出す
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE stock_counter_{name} counter")
+            for (counter_name, label), value in sorted(self.counters.items()):
+                if counter_name == name:
+                    lines.append(f"stock_counter_{name}{format_label(label)} {value}")
+
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE stock_counter_{name} histogram")
+            for (histogram_name, label), histogram in sorted(self.histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(
+                    histogram.buckets + (float("inf"),), histogram.counts
+                ):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(
+                        f"stock_counter_{name}_bucket"
+                        f"{format_label(label, le=le)} {cumulative}"
+                    )
+                lines.append(
+                    f"stock_counter_{name}_sum{format_label(label)} {histogram.sum}"
+                )
+                lines.append(
+                    f"stock_counter_{name}_count{format_label(label)} {histogram.count}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name: str) -> list[tuple[str, int, float, float, float]]:
+        # (ラベル, 件数, p50, p99, 最大) を件数の多い順に返す
+        rows = [
+            (
+                label,
+                histogram.count,
+                histogram.quantile(0.5),
+                histogram.quantile(0.99),
+                histogram.max,
+            )
+            for (histogram_name, label), histogram in self.histograms.items()
+            if histogram_name == name
+        ]
+        return sorted(rows, key=lambda row: row[1], reverse=True)
+
+    def counter_values(self, name: str) -> list[tuple[str, int]]:
+        return sorted(
+            (
+                (label, value)
+                for (counter_name, label), value in self.counters.items()
+                if counter_name == name
+            ),
+            key=lambda row: row[1],
+            reverse=True,
+        )
+
+    async def close(self) -> None:
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            try:
+                await self._lag_task
+            except asyncio.CancelledError:
+                pass
+            self._lag_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = Metrics()
@@ -0,0 +1,298 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+import discord
+
+from utils import WARN
+
+
+# 同時に実行する編集・削除の数。送信はチャンネル上の順序を保つため常に1件ずつ
+QUEUE_MAX_IN_FLIGHT = int(os.getenv("DS_BOT_STOCK_CONTROL_QUEUE_MAX_IN_FLIGHT", "5"))
+QUEUE_MAX_RETRIES = 3
+# キューがこの長さを超えたら警告を出す
+QUEUE_WARN_DEPTH = 100
+# 一括削除は14日以内のメッセージに限られ、1回100件まで
+BULK_DELETE_MAX_AGE = timedelta(days=14) - timedelta(minutes=5)
+BULK_DELETE_CHUNK = 100
+
+
+@dataclass
+class Operation:
+    kind: str  # "send" | "edit" | "delete" | "bulk_delete"
+    message_id: int | None
+    kwargs: dict
+    futures: list[asyncio.Future] = field(default_factory=list)
+    queued_at: float = field(default_factory=time.monotonic)
+
+
+class ChannelQueue:
+    # チャンネルへの送信・編集・削除をすべてこのキューに通す
+    # レート制限のバケットはdiscord.pyがX-RateLimit-*ヘッダーを読んで管理しているので、
+    # ここでは固定の待ち時間を入れずに投げ、同じメッセージへの編集は最新のものだけを送る
+    def __init__(
+        self, channel: discord.TextChannel, max_in_flight: int = QUEUE_MAX_IN_FLIGHT
+    ):
+        self.channel = channel
+        self._queue: deque[Operation] = deque()
+        self._edits: dict[int, Operation] = {}  # 未実行の編集
+        self._running: dict[int, asyncio.Task] = {}  # 実行中の編集・削除
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        # 取り出したが、まだ実行中の一覧に入っていない操作(送信中や枠の空き待ち)
+        self._current: Operation | None = None
+        # 一括削除の権限(メッセージの管理)がないとわかったら、以降は1件ずつ削除する
+        self._bulk_forbidden = False
+        # 深さの警告は QUEUE_WARN_DEPTH を超えたときに1回だけ出し、下回ったら再び出せるようにする
+        self._warned = False
+
+        self.executed = 0
+        self.merged = 0
+        self.rate_limited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self.depth,
+            "executed": self.executed,
+            "merged": self.merged,
+            "rate_limited": self.rate_limited,
+            "avg_wait": self.total_wait / self.executed if self.executed else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+    def send(self, **kwargs) -> asyncio.Future:
+        return self._put(Operation(kind="send", message_id=None, kwargs=kwargs))
+
+    def edit(self, message_id: int, **kwargs) -> asyncio.Future:
+        # まだ実行していない同じメッセージへの編集があれば、内容を上書きしてまとめる
+        pending = self._edits.get(message_id)
+        if pending is not None:
+            pending.kwargs.update(kwargs)
+            future = asyncio.get_running_loop().create_future()
+            pending.futures.append(future)
+            self.merged += 1
+            return future
+
+        operation = Operation(kind="edit", message_id=message_id, kwargs=kwargs)
+        self._edits[message_id] = operation
+        return self._put(operation)
+
+    def delete(self, message_id: int) -> asyncio.Future:
+        # 削除するメッセージへの未実行の編集は不要になる
+        self._drop_edit(message_id)
+        return self._put(Operation(kind="delete", message_id=message_id, kwargs={}))
+
+    def purge(self, message_ids: list[int]) -> list[asyncio.Future]:
+        # 14日以内のメッセージは100件ずつ一括削除し、それより古いものだけ1件ずつ削除する
+        cutoff = discord.utils.time_snowflake(
+            discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        )
+        if self._bulk_forbidden:
+            cutoff = max(message_ids, default=0)
+        recent = [message_id for message_id in message_ids if message_id > cutoff]
+        old = [message_id for message_id in message_ids if message_id <= cutoff]
+
+        for message_id in recent:
+            self._drop_edit(message_id)
+
+        futures = []
+        for start in range(0, len(recent), BULK_DELETE_CHUNK):
+            chunk = recent[start : start + BULK_DELETE_CHUNK]
+            futures.append(
+                self._put(
+                    Operation(
+                        kind="bulk_delete",
+                        message_id=None,
+                        kwargs={"message_ids": chunk},
+                    )
+                )
+            )
+        futures.extend(self.delete(message_id) for message_id in old)
+        return futures
+
+    def _drop_edit(self, message_id: int) -> None:
+        pending = self._edits.pop(message_id, None)
+        if pending is None:
+            return
+        self._queue.remove(pending)
+        for future in pending.futures:
+            if not future.done():
+                future.set_result(None)
+
+    def _put(self, operation: Operation) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        operation.futures.append(future)
+        self._queue.append(operation)
+        if self.depth > QUEUE_WARN_DEPTH and not self._warned:
+            self._warned = True
+            logging.warning(
+                WARN + f"Channel queue for {self.channel} is {self.depth} deep."
+            )
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return future
+
+    async def _run(self) -> None:
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            operation = self._queue.popleft()
+            if self.depth < QUEUE_WARN_DEPTH:
+                self._warned = False
+            if operation.kind == "edit":
+                self._edits.pop(operation.message_id, None)
+            self._current = operation
+
+            if operation.kind == "send":
+                await self._execute(operation)
+                self._current = None
+                continue
+
+            await self._semaphore.acquire()
+            previous = self._running.get(operation.message_id)
+            task = asyncio.create_task(self._execute(operation, previous))
+            self._running[operation.message_id] = task
+            self._current = None
+            task.add_done_callback(
+                lambda t, message_id=operation.message_id: self._finish(message_id, t)
+            )
+
+    async def drain(self) -> None:
+        # キューに残っている操作と実行中の操作がすべて終わるまで待つ
+        # 同じメッセージへの操作は前の操作を待ってから実行されるので、最後のものを待てばよい
+        while True:
+            operations = list(self._queue)
+            if self._current is not None:
+                operations.append(self._current)
+            waiting = [
+                future for operation in operations for future in operation.futures
+            ] + list(self._running.values())
+            if not waiting:
+                return
+            await asyncio.wait(waiting)
+
+    async def close(self) -> None:
+        # 残っている操作を送り終えてから、キューのタスクを止める
+        await self.drain()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _finish(self, message_id: int, task: asyncio.Task) -> None:
+        self._semaphore.release()
+        if self._running.get(message_id) is task:
+            del self._running[message_id]
+
+    async def _execute(
+        self, operation: Operation, previous: asyncio.Task | None = None
+    ) -> None:
+        # 同じメッセージへの操作は順番どおりに完了させる
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        waited = time.monotonic() - operation.queued_at
+        self.executed += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+        for attempt in range(QUEUE_MAX_RETRIES):
+            try:
+                result = await self._call(operation)
+            except discord.RateLimited as e:
+                self.rate_limited += 1
+                await asyncio.sleep(e.retry_after)
+                continue
+            except discord.Forbidden as e:
+                if operation.kind == "bulk_delete":
+                    self._delete_one_by_one(operation)
+                else:
+                    self._resolve(operation, exception=e)
+                return
+            except discord.HTTPException as e:
+                if e.status == 429 and attempt + 1 < QUEUE_MAX_RETRIES:
+                    self.rate_limited += 1
+                    await asyncio.sleep(1 + attempt)
+                    continue
+                self._resolve(operation, exception=e)
+                return
+            except Exception as e:
+                self._resolve(operation, exception=e)
+                return
+
+            self._resolve(operation, result=result)
+            return
+
+        self._resolve(operation, exception=RuntimeError("Too many rate limits."))
+
+    def _delete_one_by_one(self, operation: Operation) -> None:
+        # 一括削除はボット自身のメッセージでもメッセージの管理権限が要るが、1件ずつなら要らない
+        # 削除はキューに入れ直し、終わったら一括削除の完了とする(ここでは待たずに枠を空ける)
+        if not self._bulk_forbidden:
+            self._bulk_forbidden = True
+            logging.warning(
+                WARN
+                + f"Missing permission to bulk delete in {self.channel}; deleting one by one."
+            )
+        deletes = asyncio.gather(
+            *(self.delete(message_id) for message_id in operation.kwargs["message_ids"])
+        )
+
+        def done(future: asyncio.Future) -> None:
+            if future.cancelled():
+                self._resolve(operation, exception=asyncio.CancelledError())
+            elif future.exception() is not None:
+                self._resolve(operation, exception=future.exception())
+            else:
+                self._resolve(operation)
+
+        deletes.add_done_callback(done)
+
+    async def _call(self, operation: Operation):
+        if operation.kind == "send":
+            return await self.channel.send(**operation.kwargs)
+
+        if operation.kind == "bulk_delete":
+            return await self.channel.delete_messages(
+                [
+                    discord.Object(id=message_id)
+                    for message_id in operation.kwargs["message_ids"]
+                ]
+            )
+
+        message = self.channel.get_partial_message(operation.message_id)
+        if operation.kind == "edit":
+            return await message.edit(**operation.kwargs)
+
+        try:
+            await message.delete()
+        except discord.NotFound:
+            pass
+        return None
+
+    def _resolve(self, operation: Operation, result=None, exception=None) -> None:
+        for future in operation.futures:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
@@ -0,0 +1,591 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass, field
+
+import discord
+
+from db_manager import DBManager
+from embed_manager import EmbedManager
+from queue_manager import ChannelQueue
+from utils import ERROR, INFO, Stock
+from view_manager import GroupBoardView, StockManageView
+
+
+SPACER = "‎"
+# 表示形式やボタンを変えたら上げる(保存済みの配置と一致しなくなり、編集し直される)
+RENDER_VERSION = 3
+# "item" は商品ごとに1メッセージ、"group" はグループごとに1メッセージ(25商品まで)
+BOARD_MODE = os.getenv("DS_BOT_STOCK_CONTROL_BOARD_MODE", "item")
+# 1つのメッセージに載せる商品数(埋め込みのフィールドとセレクトメニューの上限)
+BOARD_PAGE_SIZE = 25
+
+
+@dataclass
+class Slot:
+    message_id: int
+    spacer_id: int | None = None
+    stock_id: str | None = None
+    rendered: tuple | None = None  # 最後に表示した内容
+
+
+def render_key(stock: Stock) -> tuple:
+    return (
+        RENDER_VERSION,
+        stock.stock_id,
+        stock.group,
+        stock.detail,
+        stock.count,
+        stock.price,
+    )
+
+
+class LayoutRenderer(ABC):
+    # チャンネル上のメッセージの配置を保存し、再起動時に使い回す表示の共通部分
+    # 配置の1要素(Slot や Page)は message_id を持つ dataclass で、その変換はサブクラスが決める
+    def __init__(
+        self,
+        channel: discord.TextChannel,
+        embed_manager: EmbedManager,
+        db_manager: DBManager,
+        layout_key: str,
+    ):
+        self.channel = channel
+        self.embed_manager = embed_manager
+        self.db_manager = db_manager
+        self.queue = ChannelQueue(channel)
+        self.layout_key = layout_key
+        self._lock = asyncio.Lock()
+
+    @abstractmethod
+    def find(self, stock_id: str): ...
+
+    def jump_url(self, stock_id: str) -> str | None:
+        entry = self.find(stock_id)
+        if entry is None:
+            return None
+        return self.channel.get_partial_message(entry.message_id).jump_url
+
+    @abstractmethod
+    async def render(self, stocks: list[Stock]) -> None: ...
+
+    @abstractmethod
+    def _from_layout(self, layout: list[dict]) -> list: ...
+
+    @abstractmethod
+    def _layout(self) -> list: ...
+
+    @abstractmethod
+    def _set_layout(self, entries: list) -> None: ...
+
+    def _message_ids(self, entry) -> list[int]:
+        return [entry.message_id]
+
+    def _prune(self, entries: list, present: set[int]) -> list:
+        # チャンネルに残っているメッセージの要素だけを残す
+        return [entry for entry in entries if entry.message_id in present]
+
+    async def restore(self, stocks: list[Stock]) -> None:
+        # 前回起動時のメッセージの配置を読み込み、停止中に変わった部分だけを更新する
+        layout = await self.db_manager.get_layout(self.layout_key)
+        if layout is None:
+            await self.reset()
+            await self.render(stocks)
+            return
+
+        entries = self._from_layout(layout)
+        # 確認が終わる前に押されたボタンでも、メッセージの位置がわかるようにしておく
+        self._set_layout(entries)
+        tracked = {
+            message_id for entry in entries for message_id in self._message_ids(entry)
+        }
+
+        # チャンネルに残っているメッセージを確認し、管理外のものは削除する
+        present = set()
+        untracked = []
+        async for message in self.channel.history(limit=None):
+            if message.id in tracked:
+                present.add(message.id)
+            else:
+                untracked.append(message.id)
+        await self._purge(untracked)
+
+        self._set_layout(self._prune(entries, present))
+        await self.render(stocks)
+
+    async def reset(self) -> None:
+        # history はページングされるので、200件を超えていてもすべて削除される
+        message_ids = [message.id async for message in self.channel.history(limit=None)]
+        await self._purge(message_ids)
+        self._set_layout([])
+        await self._save()
+
+    async def _purge(self, message_ids: list[int]) -> None:
+        results = await asyncio.gather(
+            *self.queue.purge(message_ids), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logging.error(
+                    ERROR + f"Error occurred while deleting messages:\n{result}"
+                )
+
+    async def _save(self) -> None:
+        # 再起動時にメッセージを使い回せるように配置を保存する
+        await self.db_manager.save_layout(
+            self.layout_key, [asdict(entry) for entry in self._layout()]
+        )
+
+
+class RenderManager(LayoutRenderer):
+    # チャンネル上のメッセージを上から順に「枠」として管理し、
+    # 並び替えのときは既存のメッセージを編集して使い回す
+    def __init__(
+        self,
+        channel: discord.TextChannel,
+        embed_manager: EmbedManager,
+        db_manager: DBManager,
+    ):
+        super().__init__(channel, embed_manager, db_manager, str(channel.id))
+        self.slots: list[Slot] = []
+
+    def get_embed(self, stock: Stock) -> discord.Embed:
+        return self.embed_manager.get_embed(
+            stock.detail,
+            stock.count,
+            stock.stock_id,
+            price=stock.price,
+            group=stock.group,
+        )
+
+    def find(self, stock_id: str) -> Slot | None:
+        for slot in self.slots:
+            if slot.stock_id == stock_id:
+                return slot
+        return None
+
+    def note(self, stock: Stock) -> None:
+        # ボタン操作などで表示が更新されたことを記録し、不要な編集を省く
+        slot = self.find(stock.stock_id)
+        if slot is not None:
+            slot.rendered = render_key(stock)
+
+    async def update(self, stocks: list[Stock]) -> None:
+        # 表示中の内容と異なる商品のメッセージだけを編集する
+        # 同じメッセージへの編集はキューの中で最新のものにまとめられる
+        edits = []
+        for stock in stocks:
+            slot = self.find(stock.stock_id)
+            if slot is None or slot.rendered == render_key(stock):
+                continue
+            slot.rendered = render_key(stock)
+            edits.append(self.queue.edit(slot.message_id, embed=self.get_embed(stock)))
+
+        for result in await asyncio.gather(*edits, return_exceptions=True):
+            if isinstance(result, Exception):
+                logging.error(
+                    ERROR + f"Error occurred while updating stock message:\n{result}"
+                )
+
+    def _from_layout(self, layout: list[dict]) -> list[Slot]:
+        return [
+            Slot(
+                message_id=data["message_id"],
+                spacer_id=data.get("spacer_id"),
+                stock_id=data.get("stock_id"),
+                rendered=tuple(data["rendered"]) if data.get("rendered") else None,
+            )
+            for data in layout
+        ]
+
+    def _layout(self) -> list[Slot]:
+        return self.slots
+
+    def _set_layout(self, slots: list[Slot]) -> None:
+        self.slots = slots
+
+    def _message_ids(self, slot: Slot) -> list[int]:
+        return [slot.message_id] + (
+            [slot.spacer_id] if slot.spacer_id is not None else []
+        )
+
+    def _prune(self, slots: list[Slot], present: set[int]) -> list[Slot]:
+        # 区切りのメッセージだけが消えている枠は、区切りなしで使い回す
+        for slot in slots:
+            if slot.spacer_id not in present:
+                slot.spacer_id = None
+        return super()._prune(slots, present)
+
+    async def render(self, stocks: list[Stock]) -> None:
+        async with self._lock:
+            started = time.monotonic()
+
+            # 位置ごとに表示すべき商品が変わった枠だけを編集する
+            edits = []
+            for slot, stock in zip(self.slots, stocks):
+                if slot.rendered == render_key(stock):
+                    continue
+                future = self.queue.edit(
+                    slot.message_id,
+                    embed=self.get_embed(stock),
+                    view=StockManageView.detached(stock.stock_id),
+                )
+                edits.append((slot, stock, future))
+
+            # 商品が減った分だけ末尾の枠を削除し、増えた分だけ送信する
+            deletes = [
+                self.queue.delete(message_id)
+                for slot in self.slots[len(stocks) :]
+                for message_id in (slot.message_id, slot.spacer_id)
+                if message_id is not None
+            ]
+            appends = [self._queue_append(stock) for stock in stocks[len(self.slots) :]]
+
+            for slot, stock, future in edits:
+                try:
+                    await future
+                except discord.HTTPException as e:
+                    logging.error(
+                        ERROR + f"Error occurred while editing stock message:\n{e}"
+                    )
+                    continue
+                slot.stock_id = stock.stock_id
+                slot.rendered = render_key(stock)
+
+            await asyncio.gather(*deletes, return_exceptions=True)
+            del self.slots[len(stocks) :]
+
+            for append in appends:
+                await self._finish_append(*append)
+
+            await self._save()
+            logging.info(
+                INFO
+                + f"Rendered {len(stocks)} stocks in {time.monotonic() - started:.1f}s "
+                + f"({len(edits)} edits, {len(appends)} sends, {len(deletes)} deletes, "
+                + f"queue: {self.queue.stats()})"
+            )
+
+    async def append(self, stock: Stock) -> None:
+        async with self._lock:
+            await self._finish_append(*self._queue_append(stock))
+            await self._save()
+
+    async def remove(self, stock_id: str) -> None:
+        async with self._lock:
+            slot = self.find(stock_id)
+            if slot is None:
+                return
+            for message_id in (slot.message_id, slot.spacer_id):
+                if message_id is not None:
+                    await self.queue.delete(message_id)
+            self.slots.remove(slot)
+            await self._save()
+
+    def _queue_append(self, stock: Stock) -> tuple:
+        message = self.queue.send(
+            embed=self.get_embed(stock),
+            view=StockManageView.detached(stock.stock_id),
+            silent=True,
+        )
+        spacer = self.queue.send(content=SPACER, silent=True)
+        return stock, message, spacer
+
+    async def _finish_append(
+        self, stock: Stock, message: asyncio.Future, spacer: asyncio.Future
+    ) -> None:
+        try:
+            message = await message
+        except discord.HTTPException as e:
+            logging.error(ERROR + f"Error occurred while sending stock message:\n{e}")
+            spacer.cancel()
+            return
+        try:
+            spacer = await spacer
+        except discord.HTTPException:
+            spacer = None
+
+        self.slots.append(
+            Slot(
+                message_id=message.id,
+                spacer_id=spacer.id if spacer is not None else None,
+                stock_id=stock.stock_id,
+                rendered=render_key(stock),
+            )
+        )
+
+
+@dataclass
+class Page:
+    message_id: int
+    group: str | None = None
+    stock_ids: list[str] = field(default_factory=list)
+    rendered: str | None = None  # 最後に表示した内容のハッシュ
+
+
+def paginate(stocks: list[Stock], size: int = BOARD_PAGE_SIZE) -> list[list[Stock]]:
+    # 並び順で最初に現れた順にグループを並べ、グループごとに size 件ずつに分ける
+    groups: dict[str, list[Stock]] = {}
+    for stock in stocks:
+        groups.setdefault(stock.group, []).append(stock)
+    return [
+        members[start : start + size]
+        for members in groups.values()
+        for start in range(0, len(members), size)
+    ]
+
+
+def page_key(stocks: list[Stock]) -> str:
+    # 個数だけが変わった場合も区別できるよう、表示に使うすべての値から作る
+    return hashlib.sha1(
+        repr([render_key(stock) for stock in stocks]).encode()
+    ).hexdigest()
+
+
+def view_key(stocks: list[Stock]) -> tuple:
+    # セレクトメニューの内容(個数は含まない)
+    return tuple((stock.stock_id, stock.detail, stock.price) for stock in stocks)
+
+
+class GroupBoardRenderer(LayoutRenderer):
+    # グループごとに1つのメッセージに商品を埋め込みのフィールドとして並べ、
+    # セレクトメニューで選んだ商品をボタンで増減する。メッセージ数は商品ごとの表示の1/25以下になる
+    def __init__(
+        self,
+        channel: discord.TextChannel,
+        embed_manager: EmbedManager,
+        db_manager: DBManager,
+    ):
+        # 配置は商品ごとの表示と別に保存し、表示方法を切り替えたときは作り直す
+        super().__init__(channel, embed_manager, db_manager, f"{channel.id}:groups")
+        self.pages: list[Page] = []
+        self._pages_by_stock: dict[str, Page] = {}
+        self._stocks: dict[str, Stock] = {}  # 最後に表示した商品
+
+    def _current(self, stock_id: str) -> Stock | None:
+        # まだ書き込んでいないクリックも反映した最新の値
+        return (
+            self.db_manager.buffer.projected(stock_id)
+            or self.db_manager.cache.peek(stock_id)
+            or self._stocks.get(stock_id)
+        )
+
+    def _page_stocks(self, page: Page, *overrides: Stock) -> list[Stock]:
+        replaced = {stock.stock_id: stock for stock in overrides}
+        stocks = []
+        for stock_id in page.stock_ids:
+            stock = replaced.get(stock_id) or self._current(stock_id)
+            if stock is not None:
+                stocks.append(stock)
+        return stocks
+
+    def _page_embed(self, stocks: list[Stock]) -> discord.Embed:
+        # 各商品は商品ごとの表示と同じ EmbedManager の書式で、フィールドとして並べる
+        embed = discord.Embed(
+            title=stocks[0].group if stocks else "",
+            color=discord.Color.blurple(),
+        )
+        for stock in stocks:
+            item = self.embed_manager.get_embed(
+                stock.detail,
+                stock.count,
+                stock.stock_id,
+                price=stock.price,
+                group=stock.group,
+            )
+            embed.add_field(name=item.title, value=item.description, inline=True)
+        return embed
+
+    def get_embed(self, stock: Stock) -> discord.Embed:
+        # stock を載せているメッセージ全体の埋め込み
+        page = self.find(stock.stock_id)
+        if page is None:
+            return self._page_embed([stock])
+        return self._page_embed(self._page_stocks(page, stock))
+
+    def find(self, stock_id: str) -> Page | None:
+        return self._pages_by_stock.get(stock_id)
+
+    def note(self, stock: Stock) -> None:
+        page = self.find(stock.stock_id)
+        if page is not None:
+            self._stocks[stock.stock_id] = stock
+            page.rendered = page_key(self._page_stocks(page, stock))
+
+    async def update(self, stocks: list[Stock]) -> None:
+        # 変わった商品を含むメッセージを、それぞれ1回だけ編集する
+        changed: dict[int, Page] = {}
+        for stock in stocks:
+            page = self.find(stock.stock_id)
+            if page is not None:
+                self._stocks[stock.stock_id] = stock
+                changed[page.message_id] = page
+
+        edits = []
+        for page in changed.values():
+            page_stocks = self._page_stocks(page)
+            key = page_key(page_stocks)
+            if page.rendered == key:
+                continue
+            page.rendered = key
+            edits.append(
+                self.queue.edit(page.message_id, embed=self._page_embed(page_stocks))
+            )
+
+        for result in await asyncio.gather(*edits, return_exceptions=True):
+            if isinstance(result, Exception):
+                logging.error(
+                    ERROR + f"Error occurred while updating stock message:\n{result}"
+                )
+
+    def _from_layout(self, layout: list[dict]) -> list[Page]:
+        return [Page(**data) for data in layout]
+
+    def _layout(self) -> list[Page]:
+        return self.pages
+
+    def _set_layout(self, pages: list[Page]) -> None:
+        self.pages = pages
+        self._pages_by_stock = {
+            stock_id: page for page in pages for stock_id in page.stock_ids
+        }
+
+    async def render(self, stocks: list[Stock]) -> None:
+        async with self._lock:
+            started = time.monotonic()
+            self._stocks = {stock.stock_id: stock for stock in stocks}
+            chunks = paginate(stocks)
+
+            # 位置ごとに、載せる商品や個数が変わったメッセージだけを編集する
+            edits = []
+            for page, chunk in zip(self.pages, chunks):
+                key = page_key(chunk)
+                if page.rendered == key:
+                    continue
+                kwargs = {"embed": self._page_embed(chunk)}
+                # セレクトメニューは載せる商品が変わったときだけ送り直す
+                if view_key(chunk) != view_key(self._page_stocks(page)):
+                    kwargs["view"] = GroupBoardView.detached(chunk)
+                edits.append(
+                    (page, chunk, key, self.queue.edit(page.message_id, **kwargs))
+                )
+
+            deletes = [
+                self.queue.delete(page.message_id) for page in self.pages[len(chunks) :]
+            ]
+            sends = [
+                (chunk, self._queue_send(chunk)) for chunk in chunks[len(self.pages) :]
+            ]
+
+            pages = list(self.pages[: len(chunks)])
+            for page, chunk, key, future in edits:
+                try:
+                    await future
+                except discord.HTTPException as e:
+                    logging.error(
+                        ERROR + f"Error occurred while editing stock message:\n{e}"
+                    )
+                    continue
+                page.group = chunk[0].group
+                page.stock_ids = [stock.stock_id for stock in chunk]
+                page.rendered = key
+
+            await asyncio.gather(*deletes, return_exceptions=True)
+
+            for chunk, future in sends:
+                page = await self._finish_send(chunk, future)
+                if page is not None:
+                    pages.append(page)
+
+            self._set_layout(pages)
+            await self._save()
+            logging.info(
+                INFO
+                + f"Rendered {len(stocks)} stocks in {len(chunks)} group messages "
+                + f"in {time.monotonic() - started:.1f}s "
+                + f"({len(edits)} edits, {len(sends)} sends, {len(deletes)} deletes, "
+                + f"queue: {self.queue.stats()})"
+            )
+
+    async def append(self, stock: Stock) -> None:
+        async with self._lock:
+            self._stocks[stock.stock_id] = stock
+            # 同じグループの最後のメッセージに空きがあれば載せ、なければ末尾に送信する
+            page = next(
+                (
+                    page
+                    for page in reversed(self.pages)
+                    if page.group == stock.group
+                    and len(page.stock_ids) < BOARD_PAGE_SIZE
+                ),
+                None,
+            )
+            if page is None:
+                page = await self._finish_send([stock], self._queue_send([stock]))
+                if page is not None:
+                    self.pages.append(page)
+            else:
+                page.stock_ids.append(stock.stock_id)
+                await self._edit_page(page)
+            self._set_layout(self.pages)
+            await self._save()
+
+    async def remove(self, stock_id: str) -> None:
+        async with self._lock:
+            page = self.find(stock_id)
+            if page is None:
+                return
+            page.stock_ids.remove(stock_id)
+            self._stocks.pop(stock_id, None)
+            if page.stock_ids:
+                await self._edit_page(page)
+            else:
+                await self.queue.delete(page.message_id)
+                self.pages.remove(page)
+            self._set_layout(self.pages)
+            await self._save()
+
+    async def _edit_page(self, page: Page) -> None:
+        stocks = self._page_stocks(page)
+        await self.queue.edit(
+            page.message_id,
+            embed=self._page_embed(stocks),
+            view=GroupBoardView.detached(stocks),
+        )
+        page.rendered = page_key(stocks)
+
+    def _queue_send(self, stocks: list[Stock]) -> asyncio.Future:
+        return self.queue.send(
+            embed=self._page_embed(stocks),
+            view=GroupBoardView.detached(stocks),
+            silent=True,
+        )
+
+    async def _finish_send(
+        self, stocks: list[Stock], future: asyncio.Future
+    ) -> Page | None:
+        try:
+            message = await future
+        except discord.HTTPException as e:
+            logging.error(ERROR + f"Error occurred while sending stock message:\n{e}")
+            return None
+        return Page(
+            message_id=message.id,
+            group=stocks[0].group,
+            stock_ids=[stock.stock_id for stock in stocks],
+            rendered=page_key(stocks),
+        )
+
+
+def create_renderer(
+    channel: discord.TextChannel, embed_manager: EmbedManager, db_manager: DBManager
+) -> RenderManager | GroupBoardRenderer:
+    # 表示方法は環境変数 DS_BOT_STOCK_CONTROL_BOARD_MODE で選ぶ
+    if BOARD_MODE == "group":
+        return GroupBoardRenderer(channel, embed_manager, db_manager)
+    if BOARD_MODE == "item":
+        return RenderManager(channel, embed_manager, db_manager)
+    raise ValueError(f"Unknown board mode: {BOARD_MODE}")
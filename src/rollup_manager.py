@@ -0,0 +1,306 @@
+import asyncio
+import logging
+import os
+from datetime import date, datetime, timedelta, timezone, tzinfo
+from typing import TYPE_CHECKING
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from utils import ERROR, WARN, Stock
+
+if TYPE_CHECKING:
+    from db_manager import DBManager
+
+
+# 集計をまとめて書き込むまでの秒数
+ROLLUP_FLUSH_INTERVAL = float(
+    os.getenv("DS_BOT_STOCK_CONTROL_ROLLUP_FLUSH_INTERVAL", "5.0")
+)
+
+
+def load_timezone(name: str) -> tzinfo:
+    try:
+        return ZoneInfo(name)
+    except ZoneInfoNotFoundError:
+        # タイムゾーンのデータがない環境(tzdata のないWindowsなど)でも、日本時間なら起動できるようにする
+        if name == "Asia/Tokyo":
+            return timezone(timedelta(hours=9), name)
+        raise
+
+
+# 日・時間帯の区切りに使うタイムゾーン
+REPORT_TIMEZONE = load_timezone(
+    os.getenv("DS_BOT_STOCK_CONTROL_TIMEZONE", "Asia/Tokyo")
+)
+
+
+def day_key(day: date) -> str:
+    return day.strftime("%Y-%m-%d")
+
+
+class SalesRollups:
+    # 日ごとのドキュメントに、その日の合計・時間帯ごと・グループごとの販売数と売上を加算していく
+    # {"units", "revenue", "hours": {"13": {"units", "revenue"}}, "groups": {...}}
+    # レポートは期間内の日のドキュメントだけを読めばよく、商品やイベントを読み直さない
+    def __init__(
+        self, db_manager: "DBManager", flush_interval: float = ROLLUP_FLUSH_INTERVAL
+    ):
+        self.db_manager = db_manager
+        self.flush_interval = flush_interval
+        self.collection = db_manager.collection("sales_rollups")
+        # 日 -> (フィールドへのパス -> まだ書き込んでいない加算値)
+        self._pending: dict[str, dict[tuple[str, ...], int]] = {}
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def record(self, stock: Stock, delta: int, at: datetime | None = None) -> None:
+        if delta == 0:
+            return
+        at = at or datetime.now(REPORT_TIMEZONE)
+        revenue = delta * (stock.price or 0)
+
+        increments = self._pending.setdefault(day_key(at), {})
+        for prefix in ((), ("hours", f"{at.hour:02d}"), ("groups", stock.group)):
+            for field, amount in (("units", delta), ("revenue", revenue)):
+                path = prefix + (field,)
+                increments[path] = increments.get(path, 0) + amount
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.shield(self.flush())
+
+    async def flush(self) -> None:
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            for day, increments in pending.items():
+                try:
+                    await self.db_manager._run_write(
+                        self.db_manager.backend.increment,
+                        self.collection,
+                        day,
+                        increments,
+                    )
+                except Exception as e:
+                    logging.error(
+                        ERROR + f"Error occurred while writing sales rollups:\n{e}"
+                    )
+                    # 書き込めなかった加算値は次回に持ち越す
+                    carried = self._pending.setdefault(day, {})
+                    for path, amount in increments.items():
+                        carried[path] = carried.get(path, 0) + amount
+
+    async def read(self, days: int, until: date | None = None) -> dict[str, dict]:
+        # 直近 days 日分の集計を返す(まだ書き込んでいない分も含める)
+        until = until or datetime.now(REPORT_TIMEZONE).date()
+        keys = [day_key(until - timedelta(days=i)) for i in reversed(range(days))]
+        # 期間内の日のドキュメントを1回でまとめて読む
+        documents = await self.db_manager._run(
+            self.db_manager.backend.get_many, self.collection, keys
+        )
+
+        rollups = {}
+        for key, data in zip(keys, documents):
+            data = data or {}
+            for path, amount in self._pending.get(key, {}).items():
+                nested = data
+                for field in path[:-1]:
+                    nested = nested.setdefault(field, {})
+                nested[path[-1]] = nested.get(path[-1], 0) + amount
+            rollups[key] = data
+        return rollups
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+def summarize(rollups: dict[str, dict], by: str) -> dict:
+    # by は "hour" | "day" | "group"。行は (ラベル, 販売数, 売上) の一覧
+    units = sum(data.get("units", 0) for data in rollups.values())
+    revenue = sum(data.get("revenue", 0) for data in rollups.values())
+
+    hours = [
+        (f"{day} {hour}時", values.get("units", 0), values.get("revenue", 0))
+        for day, data in rollups.items()
+        for hour, values in sorted(data.get("hours", {}).items())
+    ]
+    active_hours = [row for row in hours if row[1] != 0]
+    peak = max(active_hours, key=lambda row: row[1], default=None)
+
+    if by == "hour":
+        rows = active_hours
+    elif by == "day":
+        rows = [
+            (day, data.get("units", 0), data.get("revenue", 0))
+            for day, data in rollups.items()
+        ]
+    else:
+        groups: dict[str, list[int]] = {}
+        for data in rollups.values():
+            for group, values in data.get("groups", {}).items():
+                total = groups.setdefault(group, [0, 0])
+                total[0] += values.get("units", 0)
+                total[1] += values.get("revenue", 0)
+        rows = sorted(
+            ((group, total[0], total[1]) for group, total in groups.items()),
+            key=lambda row: row[2],
+            reverse=True,
+        )
+
+    return {
+        "units": units,
+        "revenue": revenue,
+        # 販売のあった時間帯1時間あたりの販売数
+        "velocity": units / len(active_hours) if active_hours else 0.0,
+        "peak": peak,
+        "rows": rows,
+    }
+
+
+class SalesTotals:
+    # 現在の個数から見た売上(個数 * 価格)の合計を、全体とグループごとに保持する
+    # 個数が変わるたびに差分だけを加算するので、売上の計算で商品一覧を読み直さない
+    def __init__(
+        self, db_manager: "DBManager", flush_interval: float = ROLLUP_FLUSH_INTERVAL
+    ):
+        self.db_manager = db_manager
+        self.flush_interval = flush_interval
+        self.collection = db_manager.collection("aggregates")
+        self.document = "sales"
+        self.total = 0
+        self.groups: dict[str, int] = {}
+        self._loaded = False
+        # まだ書き込んでいない加算値
+        self._pending: dict[tuple[str, ...], int] = {}
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def record(self, group: str, amount: int) -> None:
+        if self._loaded:
+            self.total += amount
+            self.groups[group] = self.groups.get(group, 0) + amount
+        for path in (("total",), ("groups", group)):
+            self._pending[path] = self._pending.get(path, 0) + amount
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.shield(self.flush())
+
+    async def flush(self) -> None:
+        async with self._lock:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        # 読み込む前に加算すると、保存済みの合計がない場合に加算値だけのドキュメントができるので、
+        # 読み込むまでは溜めておく
+        if not self._pending or not self._loaded:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self.db_manager._run_write(
+                self.db_manager.backend.increment,
+                self.collection,
+                self.document,
+                pending,
+            )
+        except Exception as e:
+            logging.error(ERROR + f"Error occurred while writing sales totals:\n{e}")
+            for path, amount in pending.items():
+                self._pending[path] = self._pending.get(path, 0) + amount
+
+    async def _recompute(self) -> tuple[int, dict[str, int]]:
+        # 書き込み待ちのクリックを反映してから、全商品から計算し直す
+        await self.db_manager.buffer.flush()
+        stocks = await self.db_manager._run(
+            self.db_manager.backend.get_stocks, self.db_manager.stocks_collection
+        )
+        groups = {}
+        for stock in stocks:
+            groups[stock.group] = groups.get(stock.group, 0) + stock.count * (
+                stock.price or 0
+            )
+        return sum(groups.values()), groups
+
+    async def _rebase(self, total: int, groups: dict[str, int]) -> None:
+        # 計算し直した値で保存済みの合計を置き換える(それまでの加算値は含まれている)
+        self._pending = {}
+        await self.db_manager._run(
+            self.db_manager.backend.set,
+            self.collection,
+            self.document,
+            {"total": total, "groups": groups},
+        )
+        self.total = total
+        self.groups = dict(groups)
+        self._loaded = True
+
+    async def load(self) -> None:
+        async with self._lock:
+            if self._loaded:
+                return
+            data = await self.db_manager._run(
+                self.db_manager.backend.get, self.collection, self.document
+            )
+            if data is None:
+                # 初回は全商品から計算する(読み込む前の加算値も含まれるので捨てる)
+                await self._rebase(*await self._recompute())
+                return
+            # 読み込む前の加算値は保存済みの合計に足してから書き込む
+            self.total = data.get("total", 0) + self._pending.get(("total",), 0)
+            self.groups = dict(data.get("groups", {}))
+            for path, amount in self._pending.items():
+                if path[0] == "groups":
+                    self.groups[path[1]] = self.groups.get(path[1], 0) + amount
+            self._loaded = True
+            await self._flush()
+
+    async def snapshot(self) -> tuple[int, dict[str, int]]:
+        await self.load()
+        return self.total, dict(self.groups)
+
+    async def verify(self) -> dict[str, tuple[int, int]]:
+        # 全商品から計算し直して保持している合計とのずれを返し、計算し直した値に揃える
+        # ラベル("total" またはグループ名) -> (保持していた値, 計算し直した値)
+        await self.load()
+        async with self._lock:
+            total, groups = await self._recompute()
+
+            drift = {}
+            if self.total != total:
+                drift["total"] = (self.total, total)
+            for group in self.groups.keys() | groups.keys():
+                running = self.groups.get(group, 0)
+                actual = groups.get(group, 0)
+                if running != actual:
+                    drift[group] = (running, actual)
+
+            await self._rebase(total, groups)
+        if drift:
+            logging.warning(WARN + f"Sales totals drifted: {drift}")
+        return drift
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._pending:
+            # 読み込む前に終了する場合も、溜めた加算値を失わないようにする
+            await self.load()
+        await self.flush()
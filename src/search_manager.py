@@ -0,0 +1,313 @@
+import bisect
+import heapq
+import re
+import threading
+import unicodedata
+
+from utils import Stock
+
+
+# ひらがな -> ローマ字(訓令式)。カタカナはひらがなに直してから変換する
+KANA_ROMAJI = dict(
+    zip(
+        "あいうえおかきくけこがぎぐげごさしすせそざじずぜぞたちつてとだぢづでど"
+        "なにぬねのはひふへほばびぶべぼぱぴぷぺぽまみむめもやゆよらりるれろわゐゑをんゔ",
+        "a i u e o ka ki ku ke ko ga gi gu ge go sa si su se so za zi zu ze zo "
+        "ta ti tu te to da zi zu de do na ni nu ne no ha hi hu he ho ba bi bu be bo "
+        "pa pi pu pe po ma mi mu me mo ya yu yo ra ri ru re ro wa i e o n vu".split(),
+    )
+)
+SMALL_KANA = {"ぁ": "a", "ぃ": "i", "ぅ": "u", "ぇ": "e", "ぉ": "o"}
+SMALL_YA = {"ゃ": "a", "ゅ": "u", "ょ": "o"}
+# ヘボン式などの綴りを訓令式に揃える(長いものから順に置き換える)
+ROMAJI_VARIANTS = [
+    ("tch", "tty"),
+    ("sh", "sy"),
+    ("ch", "ty"),
+    ("tsu", "tu"),
+    ("ji", "zi"),
+    ("ja", "zya"),
+    ("ju", "zyu"),
+    ("jo", "zyo"),
+    ("fu", "hu"),
+    ("f", "h"),
+    ("syi", "si"),
+    ("tyi", "ti"),
+]
+TOKEN_PATTERN = re.compile(r"\w+")
+# 長音の入力の違い(ラーメン / raamen)をなくすため、続く同じ母音を1つにする
+LONG_VOWEL_PATTERN = re.compile(r"([aiueo])\1+")
+# 検索語の長さごとに許す打ち間違いの数
+FUZZY_DISTANCES = ((3, 0), (5, 1))
+FUZZY_MAX_DISTANCE = 2
+
+
+def kana_to_romaji(text: str) -> str:
+    # カタカナをひらがなに揃える
+    text = "".join(
+        chr(ord(char) - 0x60) if "ァ" <= char <= "ヶ" else char for char in text
+    )
+
+    result = []
+    double_next = False
+    for char in text:
+        if char in SMALL_YA and result and result[-1].endswith("i"):
+            # きゃ -> kya、しゃ -> sya
+            result[-1] = result[-1][:-1] + "y" + SMALL_YA[char]
+            continue
+        if char in SMALL_KANA and result and len(result[-1]) > 1:
+            # ふぁ -> hua -> ha のように前の母音を置き換える
+            result[-1] = result[-1][:-1] + SMALL_KANA[char]
+            continue
+        if char == "っ":
+            double_next = True
+            continue
+        if char == "ー":
+            continue
+
+        romaji = KANA_ROMAJI.get(char) or SMALL_KANA.get(char) or char
+        if double_next and romaji[0].isalpha() and romaji[0] not in "aiueon":
+            romaji = romaji[0] + romaji
+        double_next = False
+        result.append(romaji)
+    return "".join(result)
+
+
+def normalize(text: str) -> str:
+    # 全角・半角や大文字・小文字、ひらがな・カタカナ・ローマ字の違いをなくす
+    text = kana_to_romaji(unicodedata.normalize("NFKC", text).lower())
+    for variant, canonical in ROMAJI_VARIANTS:
+        text = text.replace(variant, canonical)
+    return LONG_VOWEL_PATTERN.sub(r"\1", text)
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(normalize(text))
+
+
+def max_distance(term: str) -> int:
+    for length, distance in FUZZY_DISTANCES:
+        if len(term) <= length:
+            return distance
+    return FUZZY_MAX_DISTANCE
+
+
+def within_distance(term: str, word: str, limit: int) -> bool:
+    # word のいずれかの先頭部分との編集距離が limit 以下かどうか。途中で超えたら打ち切る
+    if len(word) < len(term) - limit:
+        return False
+    previous = list(range(len(word) + 1))
+    for i, char_a in enumerate(term, start=1):
+        current = [i]
+        for j, char_b in enumerate(word, start=1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (char_a != char_b),
+                )
+            )
+        if min(current) > limit:
+            return False
+        previous = current
+    return min(previous) <= limit
+
+
+def bigrams(text: str) -> set[str]:
+    return {text[i : i + 2] for i in range(len(text) - 1)}
+
+
+def stock_label(group: str, detail: str) -> str:
+    return f"{group} ({detail})"
+
+
+def label_keys(stock: Stock) -> set[str]:
+    # 「group (detail)」の先頭からでも、detail の先頭からでも候補に出す
+    return {normalize(stock_label(stock.group, stock.detail)), normalize(stock.detail)}
+
+
+class StockIndex:
+    # group と detail の語の転置インデックス
+    # 語のすべての接尾辞を並べておき、前方一致の二分探索で語の途中からの一致も探す
+    def __init__(self):
+        self._labels: dict[str, str] = {}  # stock_id -> 表示名
+        self._tokens: dict[str, set[str]] = {}  # stock_id -> 語
+        self._words: dict[str, set[str]] = {}  # 語 -> stock_id
+        self._suffixes: dict[str, set[str]] = {}  # 語の接尾辞 -> stock_id
+        self._sorted_suffixes: list[str] = []
+        self._bigrams: dict[str, set[str]] = {}  # 2文字 -> 語(打ち間違いの候補を絞る)
+        # 入力補完用の (正規化した表示名, stock_id) を並べた一覧
+        self._label_keys: dict[str, set[str]] = {}  # stock_id -> 正規化した表示名
+        self._sorted_labels: list[tuple[str, str]] = []
+        # リスナーのコールバックは別スレッドから呼ばれるのでロックで守る
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._labels)
+
+    def rebuild(self, stocks: list[Stock]) -> None:
+        with self._lock:
+            self._labels = {}
+            self._tokens = {}
+            self._words = {}
+            self._suffixes = {}
+            self._bigrams = {}
+            self._label_keys = {}
+            for stock in stocks:
+                self._add(stock)
+            self._sorted_suffixes = sorted(self._suffixes)
+            self._sorted_labels = sorted(
+                (key, stock_id)
+                for stock_id, keys in self._label_keys.items()
+                for key in keys
+            )
+
+    def put(self, stock: Stock) -> None:
+        with self._lock:
+            label = stock_label(stock.group, stock.detail)
+            if self._labels.get(stock.stock_id) == label:
+                return
+            self._remove(stock.stock_id)
+            for suffix in self._add(stock):
+                bisect.insort(self._sorted_suffixes, suffix)
+            for key in self._label_keys[stock.stock_id]:
+                bisect.insort(self._sorted_labels, (key, stock.stock_id))
+
+    def remove(self, stock_id: str) -> None:
+        with self._lock:
+            self._remove(stock_id)
+
+    def _add(self, stock: Stock) -> list[str]:
+        # 新しく増えた接尾辞を返す
+        tokens = set(tokenize(stock.group) + tokenize(stock.detail))
+        self._labels[stock.stock_id] = stock_label(stock.group, stock.detail)
+        self._tokens[stock.stock_id] = tokens
+        self._label_keys[stock.stock_id] = label_keys(stock)
+
+        added = []
+        for token in tokens:
+            if token not in self._words:
+                self._words[token] = set()
+                for bigram in bigrams(token):
+                    self._bigrams.setdefault(bigram, set()).add(token)
+            self._words[token].add(stock.stock_id)
+            for start in range(len(token)):
+                suffix = token[start:]
+                if suffix not in self._suffixes:
+                    self._suffixes[suffix] = set()
+                    added.append(suffix)
+                self._suffixes[suffix].add(stock.stock_id)
+        return added
+
+    def _remove(self, stock_id: str) -> None:
+        self._labels.pop(stock_id, None)
+        for key in self._label_keys.pop(stock_id, set()):
+            index = bisect.bisect_left(self._sorted_labels, (key, stock_id))
+            del self._sorted_labels[index]
+        for token in self._tokens.pop(stock_id, set()):
+            if self._discard(self._words, token, stock_id):
+                for bigram in bigrams(token):
+                    self._discard(self._bigrams, bigram, token)
+            for start in range(len(token)):
+                suffix = token[start:]
+                if self._discard(self._suffixes, suffix, stock_id):
+                    index = bisect.bisect_left(self._sorted_suffixes, suffix)
+                    del self._sorted_suffixes[index]
+
+    @staticmethod
+    def _discard(postings: dict[str, set[str]], key: str, stock_id: str) -> bool:
+        # 最後の商品がなくなったキーは消し、消したかどうかを返す
+        stock_ids = postings.get(key)
+        if stock_ids is None:
+            return False
+        stock_ids.discard(stock_id)
+        if stock_ids:
+            return False
+        del postings[key]
+        return True
+
+    def _match_term(self, term: str) -> dict[str, float]:
+        # stock_id -> 点数(語と完全一致 > 語の先頭から一致 > 語の途中から一致 > 打ち間違い)
+        scores: dict[str, float] = {}
+        # term で始まる接尾辞は並べた一覧の連続した範囲にある
+        start = bisect.bisect_left(self._sorted_suffixes, term)
+        end = bisect.bisect_left(self._sorted_suffixes, term + "\U0010ffff", start)
+        for index in range(start, end):
+            for stock_id in self._suffixes[self._sorted_suffixes[index]]:
+                tokens = self._tokens[stock_id]
+                if term in tokens:
+                    score = 3.0
+                elif any(token.startswith(term) for token in tokens):
+                    score = 2.0
+                else:
+                    score = 1.0
+                scores[stock_id] = max(scores.get(stock_id, 0.0), score)
+        if scores:
+            return scores
+
+        limit = max_distance(term)
+        if limit == 0:
+            return scores
+        # 1回の打ち間違いで変わる2文字の組は2つまでなので、残りの組が共通する語だけを比べる
+        term_bigrams = bigrams(term)
+        required = len(term_bigrams) - 2 * limit
+        shared: dict[str, int] = {}
+        for bigram in term_bigrams:
+            for word in self._bigrams.get(bigram, ()):
+                shared[word] = shared.get(word, 0) + 1
+        candidates = (
+            self._words
+            if required <= 0
+            else [word for word, count in shared.items() if count >= required]
+        )
+        for word in candidates:
+            if within_distance(term, word[: len(term) + limit], limit):
+                for stock_id in self._words[word]:
+                    scores[stock_id] = 0.5
+        return scores
+
+    def search(self, query: str, limit: int = 10) -> list[tuple[str, str]]:
+        # すべての語に一致する商品を点数の高い順に (stock_id, 表示名) で返す
+        terms = tokenize(query)
+        with self._lock:
+            if not terms:
+                return []
+            scores: dict[str, float] | None = None
+            for term in terms:
+                matches = self._match_term(term)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {
+                        stock_id: score + matches[stock_id]
+                        for stock_id, score in scores.items()
+                        if stock_id in matches
+                    }
+                if not scores:
+                    return []
+
+            ranked = heapq.nsmallest(
+                limit,
+                scores.items(),
+                key=lambda item: (-item[1], self._labels[item[0]]),
+            )
+            return [(stock_id, self._labels[stock_id]) for stock_id, _ in ranked]
+
+    def suggest(self, current: str, limit: int = 25) -> list[tuple[str, str]]:
+        # 入力中の文字列に対する候補を (stock_id, 表示名) で返す
+        # 表示名の前方一致を並べた一覧の二分探索で探し、足りなければ検索で補う
+        key = normalize(current.strip())
+        with self._lock:
+            start = bisect.bisect_left(self._sorted_labels, (key,))
+            suggestions: dict[str, str] = {}
+            for index in range(start, len(self._sorted_labels)):
+                label_key, stock_id = self._sorted_labels[index]
+                if len(suggestions) >= limit or not label_key.startswith(key):
+                    break
+                suggestions[stock_id] = self._labels[stock_id]
+        if len(suggestions) < limit and key:
+            for stock_id, label in self.search(current, limit):
+                if len(suggestions) >= limit:
+                    break
+                suggestions.setdefault(stock_id, label)
+        return list(suggestions.items())
@@ -0,0 +1,835 @@
+import json
+import logging
+import os
+import requests
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+
+import firebase_admin
+from firebase_admin import credentials, firestore
+from google.api_core import exceptions as google_exceptions
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from utils import WARN, Stock
+
+
+MAX_STOCK_COUNT = 9000000000000000
+CAS_MAX_ATTEMPTS = 5
+# 使うストレージ("firestore" か "sqlite")
+DB_BACKEND = os.getenv("DS_BOT_STOCK_CONTROL_DB_BACKEND", "firestore")
+# sqliteのファイル。":memory:" を指定すると終了時に消える一時的なdbになる
+SQLITE_PATH = os.getenv("DS_BOT_STOCK_CONTROL_SQLITE_PATH", "stock_counter.db")
+SQLITE_BUSY_TIMEOUT = 10.0
+# firestoreの1回のバッチに入れられる書き込みの上限
+FIRESTORE_BATCH_LIMIT = 500
+# firestoreの認証情報を取得するときの待ち時間の上限(秒)
+CREDENTIAL_TIMEOUT = 10.0
+
+
+class PartialWriteError(Exception):
+    # 複数の商品の書き込みの途中で失敗した場合。書き込めた商品は送り直さないようにする
+    # counts は書き込めた商品の書き込み後の個数、failed は書き込めなかった商品
+    def __init__(self, counts: dict[str, int], failed: set[str], error: Exception):
+        super().__init__(f"{len(failed)} stocks were not written: {error!r}")
+        self.counts = counts
+        self.failed = failed
+
+
+def to_stock(stock_id: str, stock_data: dict) -> Stock:
+    return Stock(
+        detail=stock_data["detail"],
+        stock_id=stock_id,
+        count=stock_data["count"],
+        price=stock_data["price"],
+        group=stock_data["group"],
+    )
+
+
+def check_count(stock_id: str, count: int, delta: int) -> int:
+    # 差分を足した後の個数を返す。上限を超える場合や0未満になる場合は ValueError
+    new_count = count + delta
+    if new_count > MAX_STOCK_COUNT:
+        raise ValueError(f"The stock count of {stock_id} is too high.")
+    if new_count < 0:
+        raise ValueError(f"The stock count of {stock_id} cannot be negative.")
+    return new_count
+
+
+def to_stock_data(stock: Stock) -> dict:
+    return {
+        "group": stock.group,
+        "detail": stock.detail,
+        "count": stock.count,
+        "price": stock.price,
+    }
+
+
+class StorageBackend(ABC):
+    # DBManager から使う保存先の共通のインターフェース
+    # どのメソッドも同期的に動くので、DBManager がスレッドプール上で呼び出す
+
+    # 汎用のドキュメント(メッセージの配置などの保存に使う)
+    @abstractmethod
+    def set(self, collection: str, document: str, data: dict) -> None: ...
+
+    @abstractmethod
+    def get(self, collection: str, document: str | None) -> dict | None: ...
+
+    def get_many(self, collection: str, documents: list[str]) -> list[dict | None]:
+        # documents と同じ順に返す。まとめて読める保存先は1回の呼び出しで読む
+        return [self.get(collection, document) for document in documents]
+
+    @abstractmethod
+    def delete(self, collection: str, document: str) -> None: ...
+
+    @abstractmethod
+    def increment(
+        self, collection: str, document: str, increments: dict[tuple[str, ...], int]
+    ) -> None:
+        # ドキュメント内の数値に加算する(キーは入れ子のフィールドへのパス)
+        # ドキュメントやフィールドがなければ0から加算する
+        ...
+
+    # 商品
+    @abstractmethod
+    def get_stock(self, collection: str, stock_id: str) -> Stock | None: ...
+
+    @abstractmethod
+    def get_stocks(self, collection: str) -> list[Stock]: ...
+
+    @abstractmethod
+    def get_stock_page(
+        self, collection: str, after: tuple[str, str] | None, limit: int
+    ) -> list[Stock]:
+        # (group, stock_id) の順に並べ、after より後の商品を limit 件まで返す
+        ...
+
+    @abstractmethod
+    def put_stock(self, collection: str, stock: Stock) -> None: ...
+
+    @abstractmethod
+    def put_stocks(self, collection: str, stocks: list[Stock]) -> None:
+        # 複数の商品をまとめて書き込む
+        ...
+
+    @abstractmethod
+    def delete_stock(self, collection: str, stock_id: str) -> None: ...
+
+    @abstractmethod
+    def apply_delta(self, collection: str, stock_id: str, delta: int) -> int:
+        # 個数に差分を足して(0未満にはしない)足した後の個数を返す
+        # 上限を超える場合は ValueError、商品がなければ KeyError
+        ...
+
+    @abstractmethod
+    def apply_deltas(self, collection: str, deltas: dict[str, int]) -> dict[str, int]:
+        # 複数の商品の差分をまとめて書き込み、書き込み後の個数を返す
+        # 存在しない商品と、上限を超える商品は書き込まず、結果に含めない
+        # 一部だけを書き込んで失敗した場合は PartialWriteError
+        ...
+
+    @abstractmethod
+    def apply_checked_deltas(
+        self, collection: str, deltas: dict[str, int]
+    ) -> dict[str, int]:
+        # すべての差分を検証してから1回でまとめて書き込み、書き込み後の個数を返す
+        # 1件でも上限を超える・0未満になる場合は ValueError、商品がなければ KeyError で、何も書き込まない
+        ...
+
+    # 個数の変更履歴(追記のみのイベント)。イベントは seq の昇順に並ぶ
+    @abstractmethod
+    def append_events(self, collection: str, events: list[dict]) -> None: ...
+
+    @abstractmethod
+    def get_events(self, collection: str, after: int) -> list[dict]: ...
+
+    @abstractmethod
+    def delete_events(self, collection: str, until: int) -> None: ...
+
+    def watch_stocks(self, collection: str, on_change):
+        # 変更を受け取れる場合は on_change(stocks, removed, initial) を呼ぶリスナーを返す
+        # (is_active と unsubscribe() を持つもの)。使えない場合は None
+        return None
+
+    def connect(self) -> None:
+        # 接続に時間のかかる保存先は、最初に使うときかこの呼び出しで接続する
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class FirestoreWatch:
+    def __init__(self, watch):
+        self._watch = watch
+
+    @property
+    def is_active(self) -> bool:
+        return self._watch.is_active
+
+    def unsubscribe(self) -> None:
+        self._watch.unsubscribe()
+
+
+class FirestoreBackend(StorageBackend):
+    def __init__(self):
+        # 認証情報の取得とfirebaseの初期化は最初に使うときまで遅らせる
+        # (DBManager のスレッドプール上で行われるので、イベントループを止めない)
+        self.cred = None
+        self._db = None
+        self._connect_lock = threading.Lock()
+        # (collection, stock_id) -> (count, update_time) 直近に読み書きした値
+        self._versions: dict[tuple[str, str], tuple] = {}
+
+    @property
+    def db(self):
+        if self._db is None:
+            self.connect()
+        return self._db
+
+    def connect(self) -> None:
+        with self._connect_lock:
+            if self._db is not None:
+                return
+            # firebaseを使わない場合は環境変数に直接、値を入れる
+            url = os.getenv("DS_BOT_STOCK_CONTROL_DB_CRED")
+            self.cred = credentials.Certificate(
+                requests.get(url, timeout=CREDENTIAL_TIMEOUT).json()
+            )
+            # 同じプロセスで2つ目のバックエンドを作った場合は初期化済みのアプリを使う
+            try:
+                app = firebase_admin.get_app()
+            except ValueError:
+                app = firebase_admin.initialize_app(self.cred)
+            self._db = firestore.client(app)
+
+    def set(self, collection: str, document: str, data: dict) -> None:
+        self.db.collection(collection).document(document).set(data)
+
+    def get(self, collection: str, document: str | None) -> dict | None:
+        if document:
+            return self.db.collection(collection).document(document).get().to_dict()
+        return {
+            doc.id: doc.to_dict() for doc in self.db.collection(collection).stream()
+        }
+
+    def get_many(self, collection: str, documents: list[str]) -> list[dict | None]:
+        refs = [
+            self.db.collection(collection).document(document) for document in documents
+        ]
+        # get_all は順序を保証しないので、IDで並べ直す
+        found = {snapshot.id: snapshot.to_dict() for snapshot in self.db.get_all(refs)}
+        return [found.get(document) for document in documents]
+
+    def delete(self, collection: str, document: str) -> None:
+        self.db.collection(collection).document(document).delete()
+
+    def increment(
+        self, collection: str, document: str, increments: dict[tuple[str, ...], int]
+    ) -> None:
+        data = {}
+        for path, amount in increments.items():
+            nested = data
+            for key in path[:-1]:
+                nested = nested.setdefault(key, {})
+            nested[path[-1]] = firestore.Increment(amount)
+        self.db.collection(collection).document(document).set(data, merge=True)
+
+    def _stock_ref(self, collection: str, stock_id: str):
+        return self.db.collection(collection).document(stock_id)
+
+    def _remember(self, collection: str, stock_id: str, count: int, update_time):
+        # 古いスナップショットで新しい値を上書きしないようにする
+        known = self._versions.get((collection, stock_id))
+        if known is not None and known[1] > update_time:
+            return
+        self._versions[(collection, stock_id)] = (count, update_time)
+
+    def get_stock(self, collection: str, stock_id: str) -> Stock | None:
+        snapshot = self._stock_ref(collection, stock_id).get()
+        if not snapshot.exists:
+            return None
+        stock = to_stock(stock_id, snapshot.to_dict())
+        self._remember(collection, stock_id, stock.count, snapshot.update_time)
+        return stock
+
+    def get_stocks(self, collection: str) -> list[Stock]:
+        return [
+            to_stock(stock_id, stock_data)
+            for stock_id, stock_data in self.get(collection, None).items()
+        ]
+
+    def get_stock_page(
+        self, collection: str, after: tuple[str, str] | None, limit: int
+    ) -> list[Stock]:
+        query = self.db.collection(collection).order_by("group").order_by("__name__")
+        if after is not None:
+            group, stock_id = after
+            query = query.start_after(
+                {"group": group, "__name__": self._stock_ref(collection, stock_id)}
+            )
+        return [to_stock(doc.id, doc.to_dict()) for doc in query.limit(limit).stream()]
+
+    def put_stock(self, collection: str, stock: Stock) -> None:
+        self.set(collection, stock.stock_id, to_stock_data(stock))
+
+    def put_stocks(self, collection: str, stocks: list[Stock]) -> None:
+        for start in range(0, len(stocks), FIRESTORE_BATCH_LIMIT):
+            batch = self.db.batch()
+            for stock in stocks[start : start + FIRESTORE_BATCH_LIMIT]:
+                self._versions.pop((collection, stock.stock_id), None)
+                batch.set(
+                    self._stock_ref(collection, stock.stock_id), to_stock_data(stock)
+                )
+            batch.commit()
+
+    def delete_stock(self, collection: str, stock_id: str) -> None:
+        self._versions.pop((collection, stock_id), None)
+        self.delete(collection, stock_id)
+
+    def watch_stocks(self, collection: str, on_change) -> FirestoreWatch:
+        initial = True
+
+        def on_snapshot(documents, changes, read_time):
+            nonlocal initial
+            if initial:
+                initial = False
+                for doc in documents:
+                    self._remember(
+                        collection, doc.id, doc.get("count"), doc.update_time
+                    )
+                on_change(
+                    [to_stock(doc.id, doc.to_dict()) for doc in documents], [], True
+                )
+                return
+
+            stocks = []
+            removed = []
+            for change in changes:
+                doc = change.document
+                if change.type.name == "REMOVED":
+                    self._versions.pop((collection, doc.id), None)
+                    removed.append(doc.id)
+                else:
+                    self._remember(
+                        collection, doc.id, doc.get("count"), doc.update_time
+                    )
+                    stocks.append(to_stock(doc.id, doc.to_dict()))
+            on_change(stocks, removed, False)
+
+        return FirestoreWatch(self.db.collection(collection).on_snapshot(on_snapshot))
+
+    def _compare_and_set(self, collection: str, stock_id: str, amount: int) -> int:
+        # 既知の更新時刻を前提条件にして書き込み、他から更新されていたら読み直す
+        ref = self._stock_ref(collection, stock_id)
+        for _ in range(CAS_MAX_ATTEMPTS):
+            known = self._versions.get((collection, stock_id))
+            if known is None:
+                snapshot = ref.get()
+                if not snapshot.exists:
+                    raise KeyError(stock_id)
+                known = (snapshot.get("count"), snapshot.update_time)
+
+            count, update_time = known
+            if count + amount > MAX_STOCK_COUNT:
+                raise ValueError("The stock count is too high.")
+            new_count = max(count + amount, 0)
+
+            try:
+                result = ref.update(
+                    {"count": new_count},
+                    option=self.db.write_option(last_update_time=update_time),
+                )
+            except google_exceptions.FailedPrecondition:
+                self._versions.pop((collection, stock_id), None)
+                continue
+
+            self._remember(collection, stock_id, new_count, result.update_time)
+            return new_count
+
+        raise RuntimeError(f"Too much contention on stock {stock_id}.")
+
+    def apply_delta(self, collection: str, stock_id: str, delta: int) -> int:
+        # 増加も前提条件付きの書き込みにして、上限を超える値を一度も書き込まないようにする
+        try:
+            return self._compare_and_set(collection, stock_id, delta)
+        except google_exceptions.NotFound:
+            raise KeyError(stock_id)
+
+    def apply_deltas(self, collection: str, deltas: dict[str, int]) -> dict[str, int]:
+        # すべての差分を前提条件付きの書き込みとして1回のバッチにまとめる
+        # バッチより前には何も書き込まないので、失敗した場合は何も反映されていない
+        unknown = [
+            self._stock_ref(collection, stock_id)
+            for stock_id in deltas
+            if (collection, stock_id) not in self._versions
+        ]
+        if unknown:
+            # 更新時刻を知らない商品はまとめて読む
+            for snapshot in self.db.get_all(unknown):
+                if snapshot.exists:
+                    self._remember(
+                        collection,
+                        snapshot.id,
+                        snapshot.get("count"),
+                        snapshot.update_time,
+                    )
+
+        planned: dict[str, int] = {}
+        batch = self.db.batch()
+        for stock_id, delta in deltas.items():
+            known = self._versions.get((collection, stock_id))
+            if known is None:
+                logging.warning(WARN + f"Stock {stock_id} no longer exists.")
+                continue
+            count, update_time = known
+            if count + delta > MAX_STOCK_COUNT:
+                logging.warning(WARN + f"The stock count of {stock_id} is too high.")
+                continue
+            new_count = max(count + delta, 0)
+            batch.update(
+                self._stock_ref(collection, stock_id),
+                {"count": new_count},
+                option=self.db.write_option(last_update_time=update_time),
+            )
+            planned[stock_id] = new_count
+
+        if not planned:
+            return {}
+
+        try:
+            results = batch.commit()
+        except (google_exceptions.FailedPrecondition, google_exceptions.NotFound):
+            # バッチは全体が失敗するので、1件ずつやり直す
+            # 1件ずつ確定するので、途中で失敗しても書き込めた商品の個数は返す
+            counts = {}
+            failed = set()
+            error = None
+            for stock_id in planned:
+                self._versions.pop((collection, stock_id), None)
+                try:
+                    counts[stock_id] = self.apply_delta(
+                        collection, stock_id, deltas[stock_id]
+                    )
+                except KeyError:
+                    logging.warning(WARN + f"Stock {stock_id} no longer exists.")
+                except ValueError:
+                    logging.warning(
+                        WARN + f"The stock count of {stock_id} is too high."
+                    )
+                except Exception as e:
+                    failed.add(stock_id)
+                    error = error or e
+            if failed:
+                raise PartialWriteError(counts, failed, error)
+            return counts
+
+        for (stock_id, new_count), result in zip(planned.items(), results):
+            self._remember(collection, stock_id, new_count, result.update_time)
+        return planned
+
+    def apply_checked_deltas(
+        self, collection: str, deltas: dict[str, int]
+    ) -> dict[str, int]:
+        # 読んだ時点の更新時刻を前提条件にした1回のバッチで書き込み、他から更新されていたら読み直す
+        if len(deltas) > FIRESTORE_BATCH_LIMIT:
+            raise ValueError(
+                f"Too many stocks in one batch (max {FIRESTORE_BATCH_LIMIT})."
+            )
+        refs = {stock_id: self._stock_ref(collection, stock_id) for stock_id in deltas}
+        for _ in range(CAS_MAX_ATTEMPTS):
+            snapshots = {
+                snapshot.id: snapshot
+                for snapshot in self.db.get_all(list(refs.values()))
+            }
+            counts = {}
+            for stock_id, delta in deltas.items():
+                snapshot = snapshots.get(stock_id)
+                if snapshot is None or not snapshot.exists:
+                    raise KeyError(stock_id)
+                counts[stock_id] = check_count(stock_id, snapshot.get("count"), delta)
+
+            batch = self.db.batch()
+            for stock_id, count in counts.items():
+                batch.update(
+                    refs[stock_id],
+                    {"count": count},
+                    option=self.db.write_option(
+                        last_update_time=snapshots[stock_id].update_time
+                    ),
+                )
+            try:
+                results = batch.commit()
+            except google_exceptions.FailedPrecondition:
+                continue
+
+            for (stock_id, count), result in zip(counts.items(), results):
+                self._remember(collection, stock_id, count, result.update_time)
+            return counts
+
+        raise RuntimeError("Too much contention on the stocks.")
+
+    def append_events(self, collection: str, events: list[dict]) -> None:
+        for start in range(0, len(events), FIRESTORE_BATCH_LIMIT):
+            batch = self.db.batch()
+            for event in events[start : start + FIRESTORE_BATCH_LIMIT]:
+                # 別のプロセスと seq が重なっても上書きしないように stock_id も含める
+                document = f"{event['seq']:020d}-{event['stock_id']}"
+                batch.set(self.db.collection(collection).document(document), event)
+            batch.commit()
+
+    def get_events(self, collection: str, after: int) -> list[dict]:
+        query = (
+            self.db.collection(collection)
+            .where(filter=FieldFilter("seq", ">", after))
+            .order_by("seq")
+        )
+        return [doc.to_dict() for doc in query.stream()]
+
+    def delete_events(self, collection: str, until: int) -> None:
+        query = self.db.collection(collection).where(
+            filter=FieldFilter("seq", "<=", until)
+        )
+        refs = [doc.reference for doc in query.stream()]
+        for start in range(0, len(refs), FIRESTORE_BATCH_LIMIT):
+            batch = self.db.batch()
+            for ref in refs[start : start + FIRESTORE_BATCH_LIMIT]:
+                batch.delete(ref)
+            batch.commit()
+
+
+class SQLiteBackend(StorageBackend):
+    # WALモードのsqliteに保存する。ネットワークを使わないので小さな会場やオフラインのイベント、
+    # テストやベンチマーク向け。個数の更新は1文の UPDATE で原子的に行う
+    def __init__(self, path: str = SQLITE_PATH):
+        # ":memory:" の場合は終了時に消す一時ファイルを使う
+        # (共有キャッシュのメモリdbでは、スレッドごとの接続の書き込みが待たずに失敗するため)
+        self._temporary = path == ":memory:"
+        if self._temporary:
+            fd, path = tempfile.mkstemp(prefix="stock_counter_", suffix=".db")
+            os.close(fd)
+        self.path = path
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+        connection = self._connection()
+        connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS stocks (
+                collection TEXT NOT NULL,
+                stock_id TEXT NOT NULL,
+                "group" TEXT NOT NULL,
+                detail TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                price INTEGER,
+                PRIMARY KEY (collection, stock_id)
+            );
+            CREATE INDEX IF NOT EXISTS stocks_group ON stocks (collection, "group");
+            CREATE TABLE IF NOT EXISTS events (
+                collection TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                stock_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                delta INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                at REAL NOT NULL,
+                PRIMARY KEY (collection, seq, stock_id)
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                collection TEXT NOT NULL,
+                document TEXT NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (collection, document)
+            );
+            """
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path,
+                timeout=SQLITE_BUSY_TIMEOUT,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def set(self, collection: str, document: str, data: dict) -> None:
+        self._connection().execute(
+            "INSERT OR REPLACE INTO documents (collection, document, data) VALUES (?, ?, ?)",
+            (collection, document, json.dumps(data)),
+        )
+
+    def get(self, collection: str, document: str | None) -> dict | None:
+        connection = self._connection()
+        if document:
+            row = connection.execute(
+                "SELECT data FROM documents WHERE collection = ? AND document = ?",
+                (collection, document),
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+        return {
+            document: json.loads(data)
+            for document, data in connection.execute(
+                "SELECT document, data FROM documents WHERE collection = ?",
+                (collection,),
+            )
+        }
+
+    def get_many(self, collection: str, documents: list[str]) -> list[dict | None]:
+        placeholders = ",".join("?" * len(documents))
+        found = {
+            document: json.loads(data)
+            for document, data in self._connection().execute(
+                "SELECT document, data FROM documents "
+                f"WHERE collection = ? AND document IN ({placeholders})",
+                (collection, *documents),
+            )
+        }
+        return [found.get(document) for document in documents]
+
+    def delete(self, collection: str, document: str) -> None:
+        self._connection().execute(
+            "DELETE FROM documents WHERE collection = ? AND document = ?",
+            (collection, document),
+        )
+
+    def increment(
+        self, collection: str, document: str, increments: dict[tuple[str, ...], int]
+    ) -> None:
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            data = self.get(collection, document) or {}
+            for path, amount in increments.items():
+                nested = data
+                for key in path[:-1]:
+                    nested = nested.setdefault(key, {})
+                nested[path[-1]] = nested.get(path[-1], 0) + amount
+            self.set(collection, document, data)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def get_stock(self, collection: str, stock_id: str) -> Stock | None:
+        row = (
+            self._connection()
+            .execute(
+                'SELECT stock_id, "group", detail, count, price FROM stocks '
+                "WHERE collection = ? AND stock_id = ?",
+                (collection, stock_id),
+            )
+            .fetchone()
+        )
+        return self._to_stock(row) if row else None
+
+    def get_stocks(self, collection: str) -> list[Stock]:
+        return [
+            self._to_stock(row)
+            for row in self._connection().execute(
+                'SELECT stock_id, "group", detail, count, price FROM stocks '
+                "WHERE collection = ?",
+                (collection,),
+            )
+        ]
+
+    def get_stock_page(
+        self, collection: str, after: tuple[str, str] | None, limit: int
+    ) -> list[Stock]:
+        group, stock_id = after if after is not None else ("", "")
+        return [
+            self._to_stock(row)
+            for row in self._connection().execute(
+                'SELECT stock_id, "group", detail, count, price FROM stocks '
+                'WHERE collection = ? AND ("group", stock_id) > (?, ?) '
+                'ORDER BY "group", stock_id LIMIT ?',
+                (collection, group, stock_id, limit),
+            )
+        ]
+
+    def put_stock(self, collection: str, stock: Stock) -> None:
+        self.put_stocks(collection, [stock])
+
+    def put_stocks(self, collection: str, stocks: list[Stock]) -> None:
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            connection.executemany(
+                'INSERT OR REPLACE INTO stocks (collection, stock_id, "group", detail, count, price) '
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        collection,
+                        stock.stock_id,
+                        stock.group,
+                        stock.detail,
+                        stock.count,
+                        stock.price,
+                    )
+                    for stock in stocks
+                ],
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def delete_stock(self, collection: str, stock_id: str) -> None:
+        self._connection().execute(
+            "DELETE FROM stocks WHERE collection = ? AND stock_id = ?",
+            (collection, stock_id),
+        )
+
+    def _update_count(
+        self, connection: sqlite3.Connection, collection: str, stock_id: str, delta: int
+    ) -> int:
+        row = connection.execute(
+            "UPDATE stocks SET count = MAX(count + ?, 0) "
+            "WHERE collection = ? AND stock_id = ? AND count + ? <= ? "
+            "RETURNING count",
+            (delta, collection, stock_id, delta, MAX_STOCK_COUNT),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+
+        exists = connection.execute(
+            "SELECT 1 FROM stocks WHERE collection = ? AND stock_id = ?",
+            (collection, stock_id),
+        ).fetchone()
+        if exists:
+            raise ValueError("The stock count is too high.")
+        raise KeyError(stock_id)
+
+    def apply_delta(self, collection: str, stock_id: str, delta: int) -> int:
+        return self._update_count(self._connection(), collection, stock_id, delta)
+
+    def apply_deltas(self, collection: str, deltas: dict[str, int]) -> dict[str, int]:
+        connection = self._connection()
+        counts = {}
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for stock_id, delta in deltas.items():
+                try:
+                    counts[stock_id] = self._update_count(
+                        connection, collection, stock_id, delta
+                    )
+                except KeyError:
+                    logging.warning(WARN + f"Stock {stock_id} no longer exists.")
+                except ValueError:
+                    logging.warning(
+                        WARN + f"The stock count of {stock_id} is too high."
+                    )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return counts
+
+    def apply_checked_deltas(
+        self, collection: str, deltas: dict[str, int]
+    ) -> dict[str, int]:
+        connection = self._connection()
+        counts = {}
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for stock_id, delta in deltas.items():
+                row = connection.execute(
+                    "SELECT count FROM stocks WHERE collection = ? AND stock_id = ?",
+                    (collection, stock_id),
+                ).fetchone()
+                if row is None:
+                    raise KeyError(stock_id)
+                counts[stock_id] = check_count(stock_id, row[0], delta)
+            connection.executemany(
+                "UPDATE stocks SET count = ? WHERE collection = ? AND stock_id = ?",
+                [(count, collection, stock_id) for stock_id, count in counts.items()],
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return counts
+
+    def append_events(self, collection: str, events: list[dict]) -> None:
+        connection = self._connection()
+        connection.execute("BEGIN")
+        try:
+            connection.executemany(
+                "INSERT OR IGNORE INTO events "
+                "(collection, seq, stock_id, kind, delta, count, at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        collection,
+                        event["seq"],
+                        event["stock_id"],
+                        event["kind"],
+                        event["delta"],
+                        event["count"],
+                        event["at"],
+                    )
+                    for event in events
+                ],
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    def get_events(self, collection: str, after: int) -> list[dict]:
+        return [
+            {
+                "seq": seq,
+                "stock_id": stock_id,
+                "kind": kind,
+                "delta": delta,
+                "count": count,
+                "at": at,
+            }
+            for seq, stock_id, kind, delta, count, at in self._connection().execute(
+                "SELECT seq, stock_id, kind, delta, count, at FROM events "
+                "WHERE collection = ? AND seq > ? ORDER BY seq",
+                (collection, after),
+            )
+        ]
+
+    def delete_events(self, collection: str, until: int) -> None:
+        self._connection().execute(
+            "DELETE FROM events WHERE collection = ? AND seq <= ?",
+            (collection, until),
+        )
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        if self._temporary:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(self.path + suffix):
+                    os.remove(self.path + suffix)
+
+    @staticmethod
+    def _to_stock(row) -> Stock:
+        stock_id, group, detail, count, price = row
+        return Stock(
+            detail=detail, stock_id=stock_id, count=count, price=price, group=group
+        )
+
+
+def create_backend(name: str = DB_BACKEND) -> StorageBackend:
+    if name == "firestore":
+        return FirestoreBackend()
+    if name == "sqlite":
+        return SQLiteBackend()
+    raise ValueError(f"Unknown storage backend: {name}")
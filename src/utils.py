@@ -1,3 +1,4 @@
+import re
 import uuid
 from dataclasses import dataclass
 
@@ -18,6 +19,22 @@ def generate_id(stock_name: str) -> str:
     return str(uuid.uuid5(uuid.NAMESPACE_DNS, stock_name))
 
 
+# "stock_id:差分" または CSVの "stock_id,差分" の組
+ADJUSTMENT_PATTERN = re.compile(
+    r"(?P<stock_id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
+    r"\s*[:,]\s*(?P<delta>[+-]?\d+)"
+)
+
+
+def parse_adjustments(text: str) -> dict[str, int]:
+    # 同じ商品が複数回あれば差分を合計する。ヘッダー行などの組になっていない部分は無視する
+    adjustments = {}
+    for match in ADJUSTMENT_PATTERN.finditer(text):
+        stock_id = match["stock_id"]
+        adjustments[stock_id] = adjustments.get(stock_id, 0) + int(match["delta"])
+    return adjustments
+
+
 @dataclass
 class Stock:
     detail: str = None
@@ -83,6 +100,13 @@ class CommandsTranslator(discord.app_commands.Translator):
                 "sort_by_count": "個数でソート",
                 "sort_by_price": "価格でソート",
                 "calc_total_sales": "売上の計算",
+                "cache_stats": "キャッシュの状態",
+                "sales_report": "売上レポート",
+                "adjust_stock": "個数の増減",
+                "bulk_adjust_stock": "個数の一括増減",
+                "import_stocks": "商品の読み込み",
+                "export_stocks": "商品の書き出し",
+                "stats": "統計",
                 "Ping the bot.": "ボットにPingを送信します。",
                 "Add a new stock to the stock list.": "商品リストに新しい商品を追加します。",
                 "Remove a stock from the stock list.": "商品リストから商品を削除します。",
@@ -92,6 +116,13 @@ class CommandsTranslator(discord.app_commands.Translator):
                 "Sort all stocks by count.": "全商品を個数でソートします。",
                 "Sort all stocks by price.": "全商品を価格でソートします。",
                 "Calculate total sales.": "売上を計算します。",
+                "Show stock cache statistics.": "商品キャッシュの統計を表示します。",
+                "Show sales by hour, day or group.": "時間帯・日・グループごとの売上を表示します。",
+                "Change a stock count by any amount.": "商品の個数を任意の数だけ増減します。",
+                "Change many stock counts at once from stock_id:delta pairs or a CSV file.": "stock_id:増減数 の組、またはCSVファイルから複数の商品の個数をまとめて増減します。",
+                "Add or update stocks from a CSV or JSON file.": "CSVまたはJSONファイルから商品を追加・更新します。",
+                "Export all stocks as a CSV or JSON file.": "全商品をCSVまたはJSONファイルに書き出します。",
+                "Show response times, database calls and rate limits.": "応答時間、dbの呼び出し、レート制限の統計を表示します。",
             },
             "en-US": {
                 "ping": "ping",
@@ -103,6 +134,13 @@ class CommandsTranslator(discord.app_commands.Translator):
                 "sort_by_count": "sort_by_count",
                 "sort_by_price": "sort_by_price",
                 "calc_total_sales": "calc_total_sales",
+                "cache_stats": "cache_stats",
+                "sales_report": "sales_report",
+                "adjust_stock": "adjust_stock",
+                "bulk_adjust_stock": "bulk_adjust_stock",
+                "import_stocks": "import_stocks",
+                "export_stocks": "export_stocks",
+                "stats": "stats",
                 "Ping the bot.": "Ping the bot.",
                 "Add a new stock to the stock list.": "Add a new stock to the stock list.",
                 "Remove a stock from the stock list.": "Remove a stock from the stock list.",
@@ -112,6 +150,13 @@ class CommandsTranslator(discord.app_commands.Translator):
                 "Sort all stocks by count.": "Sort all stocks by count.",
                 "Sort all stocks by price.": "Sort all stocks by price.",
                 "Calculate total sales.": "Calculate total sales.",
+                "Show stock cache statistics.": "Show stock cache statistics.",
+                "Show sales by hour, day or group.": "Show sales by hour, day or group.",
+                "Change a stock count by any amount.": "Change a stock count by any amount.",
+                "Change many stock counts at once from stock_id:delta pairs or a CSV file.": "Change many stock counts at once from stock_id:delta pairs or a CSV file.",
+                "Add or update stocks from a CSV or JSON file.": "Add or update stocks from a CSV or JSON file.",
+                "Export all stocks as a CSV or JSON file.": "Export all stocks as a CSV or JSON file.",
+                "Show response times, database calls and rate limits.": "Show response times, database calls and rate limits.",
             },
         }
 
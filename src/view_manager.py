@@ -1,68 +1,492 @@
+import asyncio
 import discord
 import logging
+import os
+import time
+from collections import OrderedDict
 
-from utils import (
-    INFO,
-    Stock,
+from metrics_manager import metrics
+from utils import ERROR, INFO, WARN
+
+
+# custom_id は "stock:<操作>:<stock_id>" の形式で、再起動後もここから商品を特定する
+STOCK_ID_PATTERN = r"(?P<stock_id>[0-9a-f\-]+)"
+# ボタンを押してから応答するまでの目安(秒)
+CLICK_ACK_BUDGET = 0.2
+# 同じメッセージへのクリックによる編集をまとめる時間(秒)。0ならまとめない
+CLICK_DEBOUNCE_WINDOW = float(
+    os.getenv("DS_BOT_STOCK_CONTROL_CLICK_DEBOUNCE_WINDOW", "1.0")
 )
+# 商品一覧の1ページあたりの商品数
+STOCK_LIST_PAGE_SIZE = 20
+# グループごとの表示で、選択中の商品を覚えておく (メッセージ, ユーザー) の数
+BOARD_SELECTION_LIMIT = 10000
 
+# (message_id, user_id) -> stock_id。古いものから忘れる(保存先にも書き、再起動後はそこから読む)
+board_selections: OrderedDict[tuple[int, int], str] = OrderedDict()
 
-class IncreaseButton(discord.ui.Button):
-    def __init__(self):
+
+class ClickDebouncer:
+    # メッセージごとに、期間内の最初のクリックはすぐにメッセージを編集して応答し、
+    # 後続のクリックは表示を変えずに応答して、期間の終わりに最新の個数で1回だけ編集する
+    # 1つのメッセージの編集は期間ごとに1回までになり、人気の商品を連打されても編集の制限に達しない
+    def __init__(self, window: float = CLICK_DEBOUNCE_WINDOW):
+        self.window = window
+        # message_id -> 期間の終わりに反映する (renderer, stock_id)。None なら反映するものはない
+        self._windows: dict[int, tuple | None] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def claim(self, message_id: int | None) -> bool:
+        # 期間が始まっていなければ始め、呼び出し側がすぐに編集してよいかを返す
+        if self.window <= 0 or message_id is None:
+            return True
+        if message_id in self._windows:
+            return False
+        self._open(message_id)
+        return True
+
+    def hold(self, message_id: int, renderer, stock_id: str) -> None:
+        # 期間中に並べ替えなどでメッセージの商品が変わることがあるので、
+        # 反映する商品とメッセージは期間の終わりに決める
+        self._windows[message_id] = (renderer, stock_id)
+        metrics.increment("click_edits_coalesced_total", "")
+
+    def _open(self, message_id: int) -> None:
+        self._windows[message_id] = None
+        asyncio.get_running_loop().call_later(self.window, self._close, message_id)
+
+    def _close(self, message_id: int) -> None:
+        held = self._windows.pop(message_id, None)
+        if held is None:
+            return
+        # まとめた編集を送り、その編集からも期間を空ける
+        self._open(message_id)
+        task = asyncio.create_task(self._edit(*held))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _edit(self, renderer, stock_id: str) -> None:
+        # 商品を表示している現在のメッセージを、表示中の内容と違う場合だけ編集する
+        db_manager = renderer.db_manager
+        stock = db_manager.buffer.projected(stock_id) or db_manager.cache.peek(stock_id)
+        if stock is None:
+            return
+        try:
+            await renderer.update([stock])
+        except Exception as e:
+            logging.error(ERROR + f"Error occurred while updating stock message:\n{e}")
+
+
+debouncer = ClickDebouncer()
+
+
+async def handle_click(
+    interaction: discord.Interaction, stock_id: str, delta: int, clamp: bool = True
+) -> None:
+    started = time.perf_counter()
+    # ボタンのあるチャンネルの商品一覧を使う
+    stock_channel = interaction.client.stock_channel(interaction)
+    if stock_channel is None or not stock_channel.ready:
+        await interaction.response.send_message(
+            "商品一覧を読み込んでいます。少し待ってからもう一度押してください",
+            ephemeral=True,
+        )
+        return
+    db_manager = stock_channel.db_manager
+    renderer = stock_channel.renderer
+    message_id = interaction.message.id if interaction.message else None
+    held = False
+
+    try:
+        # 選んだ商品を読み込むために、呼び出し側で先に応答している場合がある
+        if (
+            db_manager.can_answer_locally(stock_id)
+            and not interaction.response.is_done()
+        ):
+            # メモリ上の値から予測した個数ですぐに応答し、db への書き込みは後でまとめて行う
+            # 書き込みに失敗したり他の更新とずれたりした場合は、書き込み後に表示を直す
+            result = await db_manager.queue_adjust(stock_id, delta, clamp)
+            if debouncer.claim(message_id):
+                await interaction.response.edit_message(
+                    embed=renderer.get_embed(result)
+                )
+            else:
+                # 直前に編集したメッセージは、期間の終わりにまとめて編集する
+                await interaction.response.defer()
+                debouncer.hold(message_id, renderer, stock_id)
+                held = True
+        else:
+            # 商品の読み込みが必要なときは、3秒の期限に間に合うよう先に応答だけ返す
+            if not interaction.response.is_done():
+                await interaction.response.defer()
+            result = await db_manager.queue_adjust(stock_id, delta, clamp)
+            if debouncer.claim(message_id):
+                await interaction.edit_original_response(
+                    embed=renderer.get_embed(result)
+                )
+            else:
+                debouncer.hold(message_id, renderer, stock_id)
+                held = True
+    except (KeyError, ValueError) as e:
+        # 削除された商品のボタンが押された場合は KeyError になる
+        message = "商品が見つかりません" if isinstance(e, KeyError) else str(e)
+        if interaction.response.is_done():
+            await interaction.followup.send(message, ephemeral=True)
+        else:
+            await interaction.response.send_message(message, ephemeral=True)
+        return
+
+    # まとめて編集する場合は、メッセージはまだ前の個数を表示している
+    if not held:
+        renderer.note(result)
+
+    elapsed = time.perf_counter() - started
+    action = "quantity" if not clamp else "increase" if delta > 0 else "decrease"
+    metrics.observe("interaction_seconds", f"button:{action}", elapsed)
+    if elapsed > CLICK_ACK_BUDGET:
+        logging.warning(WARN + f"Button response took {elapsed * 1000:.0f}ms.")
+
+    # ログを出力
+    verb = "increased" if delta > 0 else "decreased"
+    logging.info(
+        INFO
+        + f"{result.group} ({result.detail}) was {verb} by {interaction.user.name} ({delta:+d})."
+    )
+
+
+class IncreaseButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"stock:increase:" + STOCK_ID_PATTERN,
+):
+    def __init__(self, stock_id: str):
         super().__init__(
-            label="増やす",
-            emoji="➕",
-            style=discord.ButtonStyle.primary,
+            discord.ui.Button(
+                label="増やす",
+                emoji="➕",
+                style=discord.ButtonStyle.primary,
+                custom_id=f"stock:increase:{stock_id}",
+            )
         )
+        self.stock_id = stock_id
+
+    @classmethod
+    async def from_custom_id(
+        cls,
+        interaction: discord.Interaction,
+        item: discord.ui.Button,
+        match,
+    ):
+        return cls(match["stock_id"])
 
     async def callback(self, interaction: discord.Interaction):
-        # db上の値を増やす
-        stock_id = interaction.message.embeds[0].footer.text
-        db_manager = interaction.client.db_manager
-        result = await db_manager.increment_stock(Stock(stock_id=stock_id, count=1))
-        increased_amount = result.count if isinstance(Stock, result) else None
-
-        # embedを作成して更新
-        embed = interaction.message.embeds[0]
-        embed.description = f"個数: **{increased_amount}**個\n売上: **{increased_amount * result.price}**円"
-        await interaction.response.edit_message(embed=embed)
-
-        # ログを出力
-        logging.info(
-            INFO
-            + f"{result.groupe} ({result.detail}) was increased by {interaction.user.name}."
-        )
+        await handle_click(interaction, self.stock_id, 1)
 
 
-class DecreaseButton(discord.ui.Button):
-    def __init__(self):
+class DecreaseButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"stock:decrease:" + STOCK_ID_PATTERN,
+):
+    def __init__(self, stock_id: str):
         super().__init__(
-            label="減らす",
-            emoji="➖",
-            style=discord.ButtonStyle.secondary,
+            discord.ui.Button(
+                label="減らす",
+                emoji="➖",
+                style=discord.ButtonStyle.secondary,
+                custom_id=f"stock:decrease:{stock_id}",
+            )
         )
+        self.stock_id = stock_id
+
+    @classmethod
+    async def from_custom_id(
+        cls,
+        interaction: discord.Interaction,
+        item: discord.ui.Button,
+        match,
+    ):
+        return cls(match["stock_id"])
 
     async def callback(self, interaction: discord.Interaction):
-        # db上の値を減らす
-        stock_id = interaction.message.embeds[0].footer.text
-        db_manager = interaction.client.db_manager
-        result = await db_manager.decrease_stock(Stock(stock_id=stock_id, count=1))
-        decreased_amount = result.count if isinstance(Stock, result) else None
-
-        # embedを作成して更新
-        embed = interaction.message.embeds[0]
-        embed.description = f"個数: **{decreased_amount}**個\n売上: **{decreased_amount * result.price}**円"
-        await interaction.response.edit_message(embed=embed)
-
-        # ログを出力
-        logging.info(
-            INFO
-            + f"{result.groupe} ({result.detail}) was decreased by {interaction.user.name}."
+        await handle_click(interaction, self.stock_id, -1)
+
+
+class QuantityModal(discord.ui.Modal, title="数量を入力"):
+    quantity = discord.ui.TextInput(
+        label="増減する数(減らす場合は -3 のように入力)",
+        placeholder="200",
+        max_length=20,
+    )
+
+    def __init__(self, stock_id: str):
+        super().__init__()
+        self.stock_id = stock_id
+
+    async def on_submit(self, interaction: discord.Interaction):
+        try:
+            delta = int(self.quantity.value.strip())
+        except ValueError:
+            await interaction.response.send_message(
+                "数量は整数で入力してください", ephemeral=True
+            )
+            return
+        # まとめて入力された数は切り詰めず、0未満になるなら受け付けない
+        await handle_click(interaction, self.stock_id, delta, clamp=False)
+
+
+class QuantityButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"stock:quantity:" + STOCK_ID_PATTERN,
+):
+    def __init__(self, stock_id: str):
+        super().__init__(
+            discord.ui.Button(
+                label="数量を入力",
+                emoji="🔢",
+                style=discord.ButtonStyle.secondary,
+                custom_id=f"stock:quantity:{stock_id}",
+            )
         )
+        self.stock_id = stock_id
+
+    @classmethod
+    async def from_custom_id(
+        cls,
+        interaction: discord.Interaction,
+        item: discord.ui.Button,
+        match,
+    ):
+        return cls(match["stock_id"])
+
+    async def callback(self, interaction: discord.Interaction):
+        await interaction.response.send_modal(QuantityModal(self.stock_id))
 
 
 class StockManageView(discord.ui.View):
+    def __init__(self, stock_id: str):
+        super().__init__(timeout=None)
+        self.add_item(IncreaseButton(stock_id))
+        self.add_item(DecreaseButton(stock_id))
+        self.add_item(QuantityButton(stock_id))
+
+    @classmethod
+    def detached(cls, stock_id: str) -> "StockManageView":
+        # ボタンの処理は add_dynamic_items で登録したクラスが custom_id から復元するので、
+        # 送信・編集に使うviewはメッセージごとに保持しない
+        view = cls(stock_id)
+        view.stop()
+        return view
+
+
+class StockListView(discord.ui.View):
+    # 商品一覧をページごとに読み込んで表示する。ページを開くたびにその分だけを読む
+    def __init__(self, db_manager, page_size: int = STOCK_LIST_PAGE_SIZE):
+        super().__init__(timeout=300)
+        self.db_manager = db_manager
+        self.page_size = page_size
+        # 各ページの先頭の直前の位置((group, stock_id))。1ページ目は None
+        self.cursors: list[tuple[str, str] | None] = [None]
+        self.stocks = []
+        self.has_next = False
+
+    async def load(self) -> None:
+        # 次のページがあるかどうかを知るために1件多く読む
+        stocks = await self.db_manager.get_stock_page(
+            self.cursors[-1], self.page_size + 1
+        )
+        self.has_next = len(stocks) > self.page_size
+        self.stocks = stocks[: self.page_size]
+        self.previous_page.disabled = len(self.cursors) == 1
+        self.next_page.disabled = not self.has_next
+
+    def get_embed(self) -> discord.Embed:
+        stock_list = "\n".join(
+            [
+                f"{stock.group} ({stock.detail}) ¥{stock.price} - 売上: {stock.count}個"
+                for stock in self.stocks
+            ]
+        )
+        embed = discord.Embed(
+            title="商品一覧",
+            description=stock_list or "商品はありません",
+            color=discord.Color.blurple(),
+        )
+        embed.set_footer(text=f"{len(self.cursors)}ページ目")
+        return embed
+
+    @discord.ui.button(label="前へ", emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        self.cursors.pop()
+        # ページの読み込みが3秒の期限を超えないよう、先に応答だけ返す
+        await interaction.response.defer()
+        await self.load()
+        await interaction.edit_original_response(embed=self.get_embed(), view=self)
+
+    @discord.ui.button(label="次へ", emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(
+        self, interaction: discord.Interaction, button: discord.ui.Button
+    ):
+        last = self.stocks[-1]
+        self.cursors.append((last.group, last.stock_id))
+        # ページの読み込みが3秒の期限を超えないよう、先に応答だけ返す
+        await interaction.response.defer()
+        await self.load()
+        await interaction.edit_original_response(embed=self.get_embed(), view=self)
+
+
+def select_stock(message_id: int, user_id: int, stock_id: str) -> None:
+    board_selections[(message_id, user_id)] = stock_id
+    board_selections.move_to_end((message_id, user_id))
+    while len(board_selections) > BOARD_SELECTION_LIMIT:
+        board_selections.popitem(last=False)
+
+
+async def handle_board_click(interaction: discord.Interaction, delta: int) -> None:
+    # グループのメッセージでは、そのユーザーがセレクトメニューで選んだ商品を増減する
+    message_id, user_id = interaction.message.id, interaction.user.id
+    stock_id = board_selections.get((message_id, user_id))
+    stock_channel = interaction.client.stock_channel(interaction)
+    if stock_id is None and stock_channel is not None:
+        # メモリにない選択(再起動前に選んだものなど)は保存先から読む
+        # 読み込みが3秒の期限を超えないよう、先に応答だけ返しておく
+        await interaction.response.defer()
+        try:
+            stock_id = await stock_channel.db_manager.get_board_selection(
+                message_id, user_id
+            )
+        except Exception as e:
+            logging.error(ERROR + f"Error occurred while reading selection:\n{e}")
+        if stock_id is not None:
+            select_stock(message_id, user_id, stock_id)
+
+    if stock_id is None:
+        # メニューには前に選んだ商品が表示されたままのことがあるので、選び直すよう伝える
+        message = "選んだ商品がわかりませんでした。メニューから商品を選び直してください"
+        if interaction.response.is_done():
+            await interaction.followup.send(message, ephemeral=True)
+        else:
+            await interaction.response.send_message(message, ephemeral=True)
+        return
+    await handle_click(interaction, stock_id, delta)
+
+
+class BoardSelect(
+    discord.ui.DynamicItem[discord.ui.Select],
+    template=r"board:select",
+):
+    def __init__(self, options: list[discord.SelectOption]):
+        super().__init__(
+            discord.ui.Select(
+                placeholder="商品を選択",
+                options=options,
+                custom_id="board:select",
+            )
+        )
+
+    @classmethod
+    async def from_custom_id(
+        cls,
+        interaction: discord.Interaction,
+        item: discord.ui.Select,
+        match,
+    ):
+        return cls(item.options)
+
+    async def callback(self, interaction: discord.Interaction):
+        # 選んだ商品を覚えておき、メッセージは変えずに応答する
+        message_id, user_id = interaction.message.id, interaction.user.id
+        stock_id = self.item.values[0]
+        select_stock(message_id, user_id, stock_id)
+        await interaction.response.defer()
+
+        # 再起動後も選び直さずに増減できるように保存する
+        stock_channel = interaction.client.stock_channel(interaction)
+        if stock_channel is None:
+            return
+        try:
+            await stock_channel.db_manager.save_board_selection(
+                message_id, user_id, stock_id
+            )
+        except Exception as e:
+            logging.error(ERROR + f"Error occurred while saving selection:\n{e}")
+
+
+class BoardIncreaseButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"board:increase",
+):
+    def __init__(self):
+        super().__init__(
+            discord.ui.Button(
+                label="増やす",
+                emoji="➕",
+                style=discord.ButtonStyle.primary,
+                custom_id="board:increase",
+            )
+        )
+
+    @classmethod
+    async def from_custom_id(
+        cls,
+        interaction: discord.Interaction,
+        item: discord.ui.Button,
+        match,
+    ):
+        return cls()
+
+    async def callback(self, interaction: discord.Interaction):
+        await handle_board_click(interaction, 1)
+
+
+class BoardDecreaseButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"board:decrease",
+):
     def __init__(self):
+        super().__init__(
+            discord.ui.Button(
+                label="減らす",
+                emoji="➖",
+                style=discord.ButtonStyle.secondary,
+                custom_id="board:decrease",
+            )
+        )
+
+    @classmethod
+    async def from_custom_id(
+        cls,
+        interaction: discord.Interaction,
+        item: discord.ui.Button,
+        match,
+    ):
+        return cls()
+
+    async def callback(self, interaction: discord.Interaction):
+        await handle_board_click(interaction, -1)
+
+
+class GroupBoardView(discord.ui.View):
+    # グループの商品(25件まで)を選ぶメニューと、選んだ商品を増減するボタン
+    def __init__(self, stocks: list):
         super().__init__(timeout=None)
-        self.add_item(IncreaseButton())
-        self.add_item(DecreaseButton())
+        self.add_item(
+            BoardSelect(
+                [
+                    discord.SelectOption(
+                        label=stock.detail[:100],
+                        value=stock.stock_id,
+                        description=f"¥{stock.price}",
+                    )
+                    for stock in stocks
+                ]
+            )
+        )
+        self.add_item(BoardIncreaseButton())
+        self.add_item(BoardDecreaseButton())
+
+    @classmethod
+    def detached(cls, stocks: list) -> "GroupBoardView":
+        view = cls(stocks)
+        view.stop()
+        return view